@@ -1,131 +1,894 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
     TemplateSendMessage, ButtonsTemplate, MessageAction, FlexSendMessage,
     ConfirmTemplate, ImageCarouselTemplate, ImageCarouselColumn,
     BubbleContainer, CarouselContainer, BoxComponent, TextComponent, ButtonComponent, URIAction,CarouselTemplate, CarouselColumn
 )
-from transitions.extensions import GraphMachine
 import os
 import json
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import tempfile
-import sys
+import hashlib
 import logging
 import re
-import schedule
+import sqlite3
+import uuid
+from abc import ABC, abstractmethod
+import unicodedata
 import time
-from threading import Thread
+import random
+from bisect import bisect_right, insort
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from threading import Thread, Lock, Event, BoundedSemaphore, Condition, local
 from datetime import datetime, timedelta
-from google.oauth2.service_account import Credentials
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-credentials = Credentials.from_service_account_info(
-    json.loads(GOOGLE_SHEET_JSON),
-    scopes=scope
-)
-gc = gspread.authorize(credentials)
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))  # 每個 session 保留幾個主機的連線池
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))  # 每個主機最多保留幾條 keep-alive 連線
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))  # 秒
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))  # 秒
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))  # 只重試冪等的請求與連線失敗
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.3"))  # 秒，第 n 次重試前等 backoff * 2^(n-1)
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# 🌐 共用 HTTP 連線：LINE 與 Google 各用一個 requests.Session，連線池大小、逾時、重試都在這裡設定
+_http_sessions = {}
+_http_sessions_lock = Lock()
+
+def create_http_adapter(retry_statuses=HTTP_RETRY_STATUSES):
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=retry_statuses,
+        allowed_methods=frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]),  # POST 不冪等，不在傳輸層重試
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    return HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+
+def get_http_session(name, factory=requests.Session, retry_statuses=HTTP_RETRY_STATUSES):
+    session = _http_sessions.get(name)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(name)
+            if session is None:
+                session = factory()
+                session.mount("https://", create_http_adapter(retry_statuses))
+                _http_sessions[name] = session
+    return session
+
+def http_pool_stats():
+    # 連線數遠小於請求數代表連線有被重複使用；兩者接近表示一直在重新握手
+    stats = {}
+    for name, session in list(_http_sessions.items()):
+        hosts = {}
+        pools = session.get_adapter("https://").poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[pool.host] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests
+            }
+        connections = sum(host["connections"] for host in hosts.values())
+        requests_made = sum(host["requests"] for host in hosts.values())
+        stats[name] = {
+            "hosts": hosts,
+            "reuse_ratio": round(1 - connections / requests_made, 3) if requests_made else None
+        }
+    return stats
+
+# 🪣 權杖桶：平均每秒 rate 次，最多累積 capacity 次的突發量
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        # 回傳為了等權杖而睡了幾秒，0 表示沒有被限速
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class PooledHttpClient(RequestsHttpClient):
+    # line-bot-sdk 預設每次呼叫都用 requests.get/post 重新連線，這裡改走共用的 keep-alive session
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        super().__init__(timeout)
+        self.session = get_http_session("line")
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        ))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+line_bot_api = LineBotApi(
+    os.getenv("LINE_CHANNEL_ACCESS_TOKEN"),
+    timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+    http_client=PooledHttpClient
+)
 line_handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
 
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy" if os.getenv("VERCEL") else "eager")  # lazy：參考資料改在背景載入，不擋住冷啟動
+REFERENCE_WAIT_TIMEOUT = float(os.getenv("REFERENCE_WAIT_TIMEOUT", "5"))  # 秒，背景載入還沒完成時，預約流程最多等多久
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"  # 先回 200，再交給背景工作執行緒處理事件
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "200"))
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))  # 秒，reply token 約一分鐘內有效，留一點緩衝
+USER_LOCK_STRIPES = 64
+PUSH_COALESCE_WINDOW = float(os.getenv("PUSH_COALESCE_WINDOW", "0.1"))  # 秒，同一使用者在這段時間內的推播合併成一次呼叫
+PUSH_RATE_PER_SECOND = float(os.getenv("PUSH_RATE_PER_SECOND", "1000"))  # LINE push 上限 2,000 次/秒，留一半餘裕
+MULTICAST_RATE_PER_SECOND = float(os.getenv("MULTICAST_RATE_PER_SECOND", "100"))  # multicast 上限 200 次/秒
+PUSH_MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", "5"))
+PUSH_MESSAGES_PER_CALL = 5  # 一次 push/multicast 最多 5 則訊息
+MULTICAST_MAX_RECIPIENTS = 500
+
 SPREADSHEET_KEY = os.getenv("GOOGLE_SPREADSHEET_KEY")
 logger.info(f"[DEBUG] 當前使用的 SPREADSHEET_KEY: {SPREADSHEET_KEY}")
+MEMBER_SPREADSHEET_KEY = "1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg"  # 場地/教練/課程/常見問題/會員資料
+MEMBER_ID_PATTERN = re.compile(r"^[A-Z]\d{5}$")  # A00001 類型
+MEMBER_MATCH_LIST_LIMIT = 10
+COURSE_CALENDAR_MAX_DAYS = int(os.getenv("COURSE_CALENDAR_MAX_DAYS", "400"))  # 單一課程最多展開幾天，避免日期打錯時爆量
+GSPREAD_SCOPES = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/drive"
+]
+GOOGLE_TOKEN_REFRESH_MARGIN = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))  # 權杖到期前幾秒先更新
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))  # Sheets API 每位使用者每分鐘 60 次讀取
+SHEETS_READ_BURST = int(os.getenv("SHEETS_READ_BURST", "10"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "4"))  # 429/5xx 的重試次數
+SHEETS_BACKOFF_MAX = 32  # 秒
+SHEETS_CHUNK_ROWS = int(os.getenv("SHEETS_CHUNK_ROWS", "1000"))  # 大表分段讀取時每段幾列
+SHEET_COLUMNS = {
+    # 只用到部分欄位的工作表：只下載這些欄，其餘欄位再多再長都不影響讀取量
+    '常見問題': ('分類', '問題', '答覆')
+}
+SHEETS_BREAKER_FAILURES = int(os.getenv("SHEETS_BREAKER_FAILURES", "5"))  # 連續幾次失敗或過慢就斷路
+SHEETS_BREAKER_SLOW_SECONDS = float(os.getenv("SHEETS_BREAKER_SLOW_SECONDS", "8"))  # 單次呼叫超過幾秒算過慢
+SHEETS_BREAKER_COOLDOWN = float(os.getenv("SHEETS_BREAKER_COOLDOWN", "30"))  # 斷路後幾秒再放一個請求試探
+# 參考資料工作表快取秒數（一天只會改幾次）
+WORKSHEET_CACHE_TTL = {
+    '場地資料': 600,
+    '教練資料': 600,
+    '課程資料': 600,
+    '常見問題': 1800,
+    '會員資料': 60
+}
+WORKSHEET_CACHE_DEFAULT_TTL = int(os.getenv("WORKSHEET_CACHE_DEFAULT_TTL", "300"))
+WORKSHEET_CACHE_STALE_TTL = int(os.getenv("WORKSHEET_CACHE_STALE_TTL", "3600"))  # 過期後仍可先回舊資料、背景更新的秒數
+WORKSHEET_CACHE_MAX_ENTRIES = int(os.getenv("WORKSHEET_CACHE_MAX_ENTRIES", "32"))
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "256"))  # 已組好的回覆訊息最多保留幾份
+REFERENCE_SHEETS = ['場地資料', '教練資料', '課程資料', '常見問題']  # 位於 MEMBER_SPREADSHEET_KEY
+REFERENCE_REFRESH_INTERVAL = int(os.getenv("REFERENCE_REFRESH_INTERVAL", "600"))  # 秒，0 表示不在背景更新
+REFERENCE_REFRESH_JITTER = int(os.getenv("REFERENCE_REFRESH_JITTER", "60"))  # 每次間隔隨機多等 0~N 秒
+REFERENCE_SNAPSHOT_PATH = os.getenv("REFERENCE_SNAPSHOT_PATH", "/tmp/linebot_reference_snapshot.json")  # 空字串表示不存檔
+REFERENCE_SNAPSHOT_MAX_AGE = int(os.getenv("REFERENCE_SNAPSHOT_MAX_AGE", "604800"))  # 秒，太舊的快照檔不使用
+REFERENCE_SNAPSHOT_FORMAT = 1  # 快照檔格式版本，結構改變時要加一
 BOOKING_OPTIONS_SHEETS = {
     '預約團體課程': '課程資料',
     '預約私人教練': '教練資料',
     '場地租借': '場地資料'
 }
+BOOKING_SHEET_MAPPING = {
+    '預約團體課程': '課程資料',
+    '預約私人教練': '教練資料',
+    '場地租借': '場地資料'
+}
+BOOKING_CONFLICT_MINUTES = 120  # 同一教練/場地兩筆預約需相隔 2 小時
+BOOKING_INDEX_TTL = int(os.getenv("BOOKING_INDEX_TTL", "600"))  # 秒，定期從試算表重建以納入他人手動修改
+BOOKING_JOURNAL_PATH = os.getenv("BOOKING_JOURNAL_PATH", "/tmp/booking_journal.db")  # 僅限本機；Serverless 上不保證留存
+BOOKING_FLUSH_INTERVAL = float(os.getenv("BOOKING_FLUSH_INTERVAL", "2"))  # 秒
+BOOKING_FLUSH_BATCH_SIZE = 200
+BOOKING_FLUSH_MAX_ATTEMPTS = 6
 BOOKING_COLUMN_MAPPING = {
     '課程資料': '課程名稱',
     '教練資料': '專長',
     '場地資料': '名稱'
 }
-user_states = {}
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory / sqlite / redis
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))  # 秒，閒置超過即失效
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))  # 記憶體中最多保留幾位使用者的對話
+SESSION_SWEEP_INTERVAL = 60  # 秒
+SESSION_EXPIRED_NOTICE = os.getenv("SESSION_EXPIRED_NOTICE", "1") == "1"  # 逾時後下一則訊息提醒使用者
+SESSION_EXPIRED_NOTICE_TTL = int(os.getenv("SESSION_EXPIRED_NOTICE_TTL", "86400"))  # 逾時多久內還會提醒
+SESSION_TOMBSTONE_LIMIT = 10000
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "/tmp/linebot_sessions.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+READ_MODEL_PATH = os.getenv("READ_MODEL_PATH", "")  # 例如 /tmp/linebot_read_model.db，空字串表示不啟用本機查詢副本
+READ_MODEL_SYNC_INTERVAL = int(os.getenv("READ_MODEL_SYNC_INTERVAL", "60"))  # 秒，會員資料的同步間隔
+READ_MODEL_SOURCES = {
+    # 資料表: (來源, 工作表, 建立索引的欄位)；來源 member 為 MEMBER_SPREADSHEET_KEY
+    # 預約工作表不在此列：衝突檢查已有依欄位分批讀取的 BookingIntervalIndex，不必再整張下載
+    'venues': ('member', '場地資料', ('類型', '分類', '名稱')),
+    'coaches': ('member', '教練資料', ('教練類型', '教練類別', '姓名')),
+    'courses': ('member', '課程資料', ('課程類型', '課程名稱')),  # 依日期查詢改用 CourseCalendar
+    'faqs': ('member', '常見問題', ('分類',)),
+    'members': ('member', '會員資料', ('會員編號', '姓名'))
+}
 
-class BookingFSM:
-    def __init__(self, user_id, states, transitions, initial):
-        # 您的初始化程式碼
-        pass
-def load_booking_options():
-    global booking_options
+# 🗂️ 對話狀態儲存：只存精簡的 JSON，多個執行個體共用 SQLite/Redis 時不需要固定路由
+class SessionStore(ABC):
+    def __init__(self):
+        self.expired_count = 0
+        self.evicted_count = 0
+        self._expired = OrderedDict()  # 最近逾時的 user_id -> 逾時時間，用來提醒使用者
+        self._expired_lock = Lock()
+
+    @abstractmethod
+    def get(self, user_id):
+        ...
+
+    @abstractmethod
+    def set(self, user_id, data, ttl):
+        ...
+
+    @abstractmethod
+    def delete(self, user_id):
+        ...
+
+    def live_count(self):
+        return None
+
+    def pop_expired(self, user_id):
+        with self._expired_lock:
+            expired_at = self._expired.pop(user_id, None)
+        return expired_at is not None and time.time() - expired_at < SESSION_EXPIRED_NOTICE_TTL
+
+    def stats(self):
+        return {"live": self.live_count(), "evicted": self.evicted_count, "expired": self.expired_count}
+
+    def _mark_expired(self, user_id):
+        with self._expired_lock:
+            self.expired_count += 1
+            self._expired[user_id] = time.time()
+            self._expired.move_to_end(user_id)
+            while len(self._expired) > SESSION_TOMBSTONE_LIMIT:
+                self._expired.popitem(last=False)
+
+class MemorySessionStore(SessionStore):
+    # 有上限的 LRU：閒置逾時就失效，超過上限時淘汰最久沒互動的對話
+    def __init__(self, max_entries=SESSION_MAX_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._sessions = OrderedDict()  # user_id -> (JSON, 到期時間, ttl)，越後面越近期
+        self._last_sweep = time.time()
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._sessions[user_id]
+                self._mark_expired(user_id)
+                return None
+            self._sessions[user_id] = (entry[0], now + entry[2], entry[2])
+            self._sessions.move_to_end(user_id)
+        return json.loads(entry[0])
+
+    def set(self, user_id, data, ttl):
+        now = time.time()
+        with self._lock:
+            self._sessions[user_id] = (json.dumps(data, ensure_ascii=False), now + ttl, ttl)
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+                self.evicted_count += 1
+            if now - self._last_sweep > SESSION_SWEEP_INTERVAL:
+                self._sweep(now)
+
+    def delete(self, user_id):
+        with self._lock:
+            return self._sessions.pop(user_id, None) is not None
+
+    def live_count(self):
+        return len(self._sessions)
+
+    def _sweep(self, now):
+        # 依最近互動排序，最前面的閒置最久；逐一移除到期的對話
+        self._last_sweep = now
+        while self._sessions:
+            user_id, entry = next(iter(self._sessions.items()))
+            if entry[1] > now:
+                break
+            del self._sessions[user_id]
+            self._mark_expired(user_id)
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path):
+        super().__init__()
+        self._lock = Lock()
+        self._last_sweep = time.time()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, ttl REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")]
+        if "ttl" not in columns:
+            # 舊版資料表沒有 ttl 欄位，補上後沿用預設閒置時間
+            self._conn.execute(f"ALTER TABLE sessions ADD COLUMN ttl REAL NOT NULL DEFAULT {SESSION_TTL}")
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data, expires_at, ttl FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                self._mark_expired(user_id)
+                return None
+            # 與記憶體後端相同：有互動就把到期時間往後延
+            self._conn.execute("UPDATE sessions SET expires_at = ? WHERE user_id = ?", (now + row[2], user_id))
+        return json.loads(row[0])
+
+    def set(self, user_id, data, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, expires_at, ttl) VALUES (?, ?, ?, ?)",
+                (user_id, json.dumps(data, ensure_ascii=False), now + ttl, ttl)
+            )
+            if now - self._last_sweep > SESSION_SWEEP_INTERVAL:
+                self._last_sweep = now
+                expired = self._conn.execute("SELECT user_id FROM sessions WHERE expires_at <= ?", (now,)).fetchall()
+                self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+                for (expired_user_id,) in expired:
+                    self._mark_expired(expired_user_id)
+
+    def delete(self, user_id):
+        with self._lock:
+            return self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def live_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+
+class RedisSessionStore(SessionStore):
+    # client 只需支援 get / set(ex=) / expire / delete，測試時可換成 fakeredis 等本機替身
+    # 逾時由 Redis TTL 處理；另存一個較長效的標記，標記還在但對話不在就代表逾時
+    # 與記憶體後端相同，每次讀取都會把到期時間往後延，ttl 隨資料一起存
+    def __init__(self, client, prefix="linebot:session:"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, user_id):
+        value = self.client.get(self.prefix + user_id)
+        if not value:
+            return None
+        data = json.loads(value)
+        ttl = data.pop("_ttl", SESSION_TTL)
+        self.client.expire(self.prefix + user_id, ttl)
+        self.client.expire(self.prefix + user_id + ":seen", ttl + SESSION_EXPIRED_NOTICE_TTL)
+        return data
+
+    def set(self, user_id, data, ttl):
+        self.client.set(self.prefix + user_id, json.dumps(dict(data, _ttl=ttl), ensure_ascii=False), ex=ttl)
+        self.client.set(self.prefix + user_id + ":seen", 1, ex=ttl + SESSION_EXPIRED_NOTICE_TTL)
+
+    def delete(self, user_id):
+        self.client.delete(self.prefix + user_id + ":seen")
+        return bool(self.client.delete(self.prefix + user_id))
+
+    def pop_expired(self, user_id):
+        if self.client.get(self.prefix + user_id) or not self.client.delete(self.prefix + user_id + ":seen"):
+            return False
+        self.expired_count += 1
+        return True
+
+def create_session_store():
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionStore(SESSION_SQLITE_PATH)
+    if SESSION_BACKEND == "redis":
+        import redis  # 選用套件，只有 SESSION_BACKEND=redis 時才需要安裝
+        return RedisSessionStore(redis.Redis.from_url(REDIS_URL))
+    return MemorySessionStore()
+
+class UserStateMap:
+    # 維持原本 dict 的用法：值可以是狀態字串或 BookingFSM，實際存放的是序列化後的資料
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def get(self, user_id, default=None):
+        data = self.store.get(user_id)
+        if data is None:
+            return default
+        if "fsm" in data:
+            return BookingFSM.from_session(user_id, data)
+        return data["state"]
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        data = value.to_session() if isinstance(value, BookingFSM) else {"state": value}
+        self.store.set(user_id, data, self.ttl)
+
+    def __delitem__(self, user_id):
+        if not self.store.delete(user_id):
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id):
+        return self.store.get(user_id) is not None
+
+    def pop_expired(self, user_id):
+        return self.store.pop_expired(user_id)
+
+    def stats(self):
+        return self.store.stats()
+
+    def pop(self, user_id, *default):
+        value = self.get(user_id)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(user_id)
+        self.store.delete(user_id)
+        return value
+
+def parse_session_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+    except ValueError:
+        return value
+
+def parse_session_time(value):
+    try:
+        return datetime.strptime(value, "%H:%M").time() if value else None
+    except ValueError:
+        return value
+
+user_states = UserStateMap(create_session_store(), SESSION_TTL)
+def build_booking_category(category, records):
+    column_name = BOOKING_COLUMN_MAPPING.get(BOOKING_OPTIONS_SHEETS[category], "項目")
+    if category == "預約私人教練":
+        # 🧠 私人教練特殊格式（需要兩欄：專長 和 教練姓名）
+        specialty_col = "專長"
+        coach_col = "姓名"
+        specialty_map = {}
+        for row in records:
+            spec = row.get(specialty_col)
+            coach = row.get(coach_col)
+            if spec and coach:
+                specialty_map.setdefault(spec, []).append(coach)
+        return {"專長": specialty_map}
+    # ✅ 其他類別（團體課程/場地租借）
+    items = [row.get(column_name) for row in records if row.get(column_name)]
+    return {"items": items}
+
+def booking_category_size(content):
+    if "專長" in content:
+        return sum(len(coaches) for coaches in content["專長"].values())
+    return len(content["items"])
+
+def load_booking_options(records_by_sheet=None, previous=None):
+    # 有 previous 時只重建 records_by_sheet 裡有的工作表所對應的類別，其餘類別直接沿用
+    import gspread
     booking_options = {"categories": {}}
+    rebuilt = []
     try:
-        client = get_gspread_client()
+        if records_by_sheet is None:
+            records_by_sheet = batch_get_records(SPREADSHEET_KEY, list(BOOKING_OPTIONS_SHEETS.values()))
         for category, sheet_name in BOOKING_OPTIONS_SHEETS.items():
-            column_name = BOOKING_COLUMN_MAPPING.get(sheet_name, "項目")
-            logger.info(f"嘗試載入 {category} 的預約選項，工作表：{sheet_name}，欄位：{column_name}")
-
+            if previous is not None and sheet_name not in records_by_sheet:
+                if category in previous["categories"]:
+                    booking_options["categories"][category] = previous["categories"][category]
+                continue
             try:
-                sheet = client.open_by_key(SPREADSHEET_KEY).worksheet(sheet_name)
-                records = sheet.get_all_records()
-
-                if category == "預約私人教練":
-                    # 🧠 私人教練特殊格式（需要兩欄：專長 和 教練姓名）
-                    specialty_col = "專長"
-                    coach_col = "姓名"
-                    specialty_map = {}
-                    for row in records:
-                        spec = row.get(specialty_col)
-                        coach = row.get(coach_col)
-                        if spec and coach:
-                            specialty_map.setdefault(spec, []).append(coach)
-                    booking_options["categories"][category] = {"專長": specialty_map}
-                else:
-                    # ✅ 其他類別（團體課程/場地租借）
-                    items = [row.get(column_name) for row in records if row.get(column_name)]
-                    booking_options["categories"][category] = {"items": items}
-
-                logger.info(f"✅ {category} 選項載入成功")
+                records = records_by_sheet.get(sheet_name)
+                if records is None:
+                    raise gspread.exceptions.WorksheetNotFound(sheet_name)
+                booking_options["categories"][category] = build_booking_category(category, records)
+                rebuilt.append(category)
 
             except gspread.exceptions.WorksheetNotFound:
                 logger.error(f"❌ 找不到工作表：{sheet_name}，跳過 {category}")
             except Exception as e:
                 logger.error(f"❌ 載入 {category} 失敗：{e}", exc_info=True)
 
-        logger.info("[DEBUG] booking_options 結構如下：")
-        for category, content in booking_options["categories"].items():
-            logger.info(f" - {category}：{content}")
+        if rebuilt:
+            counts = "、".join(
+                f"{category} {booking_category_size(booking_options['categories'][category])} 項" for category in rebuilt
+            )
+            logger.info(f"✅ 預約選項已重建：{counts}")
 
     except Exception as e:
         logger.critical(f"❌ 預約資料整體載入失敗：{e}", exc_info=True)
         booking_options = {"categories": {}}
+    return booking_options
+
+# 🔄 參考資料背景更新：整批載入成不可變快照後一次替換，請求執行緒只讀目前快照
+ReferenceSnapshot = namedtuple("ReferenceSnapshot", ["booking_options", "sheets", "loaded_at", "duration"])
+reference_snapshot = ReferenceSnapshot({"categories": {}}, MappingProxyType({}), None, None)
+booking_options = reference_snapshot.booking_options
+reference_refresh_error = None
+reference_source = None  # "sheets" 或 "file"
+_reference_refresh_lock = Lock()
+reference_ready = Event()  # 第一次載入（不論成功與否）結束後設定
+_sheet_hashes = {}  # (spreadsheet_key, sheet_name) -> 上次套用的內容雜湊
+reference_listeners = []
+
+def on_reference_change(listener):
+    # listener(changed_sheets, changed_categories)：只有內容真的變動時才會被呼叫
+    reference_listeners.append(listener)
+    return listener
+
+def sheet_content_hash(records):
+    return hashlib.sha1(
+        json.dumps(records, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+def diff_sheets(spreadsheet_key, records_by_sheet, hashes):
+    # 回傳內容有變動的工作表；新的雜湊先放進 hashes，整批套用成功後才寫回 _sheet_hashes
+    changed = {}
+    for sheet_name, records in records_by_sheet.items():
+        digest = sheet_content_hash(records)
+        if _sheet_hashes.get((spreadsheet_key, sheet_name)) != digest:
+            changed[sheet_name] = records
+            hashes[(spreadsheet_key, sheet_name)] = digest
+    return changed
+
+def refresh_reference_data():
+    global reference_snapshot, booking_options, reference_refresh_error, reference_source
+    if not _reference_refresh_lock.acquire(blocking=False):
+        logger.info("參考資料正在更新中，略過這次排程")
+        return
+    try:
+        started = time.monotonic()
+        previous = reference_snapshot
+        sheets = dict(previous.sheets)
+        loaded = {}
+        errors = []
+        hashes = {}
+        try:
+            # 同一份試算表的所有工作表只打一次 values.batchGet
+            loaded = {
+                sheet_name: tuple(records)
+                for sheet_name, records in batch_get_records(MEMBER_SPREADSHEET_KEY, REFERENCE_SHEETS).items()
+            }
+        except Exception as e:
+            logger.error(f"❌ 參考資料批次讀取失敗，沿用上一版：{e}")
+        for sheet_name in REFERENCE_SHEETS:
+            if sheet_name not in loaded:
+                errors.append(f"{sheet_name} 更新失敗")
+        changed_sheets = diff_sheets(MEMBER_SPREADSHEET_KEY, loaded, hashes)
+        sheets.update(changed_sheets)  # 沒變動的工作表沿用原本的物件，下游以物件身分判斷是否要重建
+
+        if SPREADSHEET_KEY == MEMBER_SPREADSHEET_KEY:
+            changed_booking = {name: changed_sheets[name] for name in BOOKING_OPTIONS_SHEETS.values() if name in changed_sheets}
+        else:
+            try:
+                booking_records = batch_get_records(SPREADSHEET_KEY, list(BOOKING_OPTIONS_SHEETS.values()))
+            except Exception as e:
+                logger.error(f"❌ 預約選項工作表讀取失敗，沿用上一版：{e}")
+                booking_records = {}
+            changed_booking = diff_sheets(SPREADSHEET_KEY, booking_records, hashes)
+        options = previous.booking_options
+        if changed_booking:
+            options = load_booking_options(changed_booking, previous.booking_options)
+        if not options["categories"] and previous.booking_options["categories"]:
+            errors.append("預約選項載入失敗")
+            options = previous.booking_options
+        changed_categories = frozenset(
+            category for category, content in options["categories"].items()
+            if previous.booking_options["categories"].get(category) is not content
+        )
+
+        duration = time.monotonic() - started
+        for sheet_name in loaded:
+            worksheet_cache.put(MEMBER_SPREADSHEET_KEY, sheet_name, sheets[sheet_name])
+        booking_options = options
+        reference_snapshot = ReferenceSnapshot(options, MappingProxyType(sheets), datetime.now(), duration)
+        reference_refresh_error = "；".join(errors) or None
+        _sheet_hashes.update(hashes)
+        if changed_sheets or changed_categories:
+            logger.info(
+                f"✅ 參考資料更新完成，耗時 {duration:.2f} 秒，變動工作表：{'、'.join(changed_sheets) or '無'}，"
+                f"變動預約類別：{'、'.join(changed_categories) or '無'}"
+            )
+            for listener in reference_listeners:
+                try:
+                    listener(frozenset(changed_sheets), changed_categories)
+                except Exception as e:
+                    logger.error(f"❌ 參考資料變動通知失敗：{e}", exc_info=True)
+        else:
+            logger.info(f"✅ 參考資料更新完成，耗時 {duration:.2f} 秒，內容沒有變動")
+        if loaded:
+            reference_source = "sheets"
+            save_reference_snapshot(reference_snapshot)
+    finally:
+        _reference_refresh_lock.release()
+        reference_ready.set()
+
+# 💾 參考資料快照檔：新的執行個體先用上次存下的資料回應，再於背景向試算表重新驗證
+def reference_snapshot_header():
+    return {
+        "format": REFERENCE_SNAPSHOT_FORMAT,
+        "spreadsheets": [SPREADSHEET_KEY, MEMBER_SPREADSHEET_KEY],
+        "sheets": REFERENCE_SHEETS
+    }
+
+def save_reference_snapshot(snapshot):
+    if not REFERENCE_SNAPSHOT_PATH:
+        return
+    data = dict(reference_snapshot_header())
+    data.update({
+        "saved_at": time.time(),
+        "booking_options": snapshot.booking_options,
+        "records": {name: list(records) for name, records in snapshot.sheets.items()}
+    })
+    temp_path = f"{REFERENCE_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, REFERENCE_SNAPSHOT_PATH)  # 整檔替換，其他行程不會讀到寫一半的檔案
+    except OSError as e:
+        logger.warning(f"參考資料快照檔寫入失敗：{e}")
+
+def restore_reference_snapshot():
+    global reference_snapshot, booking_options, reference_source
+    if not REFERENCE_SNAPSHOT_PATH:
+        return False
+    try:
+        with open(REFERENCE_SNAPSHOT_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        logger.warning(f"參考資料快照檔無法讀取，改從試算表載入：{e}")
+        return False
+    header = reference_snapshot_header()
+    if any(data.get(field) != value for field, value in header.items()):
+        logger.info("參考資料快照檔版本或來源不符，改從試算表載入")
+        return False
+    age = time.time() - data.get("saved_at", 0)
+    if age > REFERENCE_SNAPSHOT_MAX_AGE:
+        logger.info(f"參考資料快照檔已存放 {age / 3600:.0f} 小時，改從試算表載入")
+        return False
+    sheets = {name: tuple(records) for name, records in data["records"].items()}
+    for sheet_name, records in sheets.items():
+        worksheet_cache.put(MEMBER_SPREADSHEET_KEY, sheet_name, records)
+        _sheet_hashes[(MEMBER_SPREADSHEET_KEY, sheet_name)] = sheet_content_hash(records)
+    booking_options = data["booking_options"]
+    reference_snapshot = ReferenceSnapshot(
+        booking_options, MappingProxyType(sheets), datetime.fromtimestamp(data["saved_at"]), None
+    )
+    reference_source = "file"
+    reference_ready.set()
+    logger.info(f"💾 已從快照檔載入參考資料（{age:.0f} 秒前存檔），背景重新驗證中")
+    return True
+
+def wait_for_reference_data(timeout=REFERENCE_WAIT_TIMEOUT):
+    if not reference_ready.wait(timeout):
+        logger.warning(f"參考資料 {timeout} 秒內仍未載入完成，先以目前資料繼續")
+
+def start_reference_refresher():
+    if REFERENCE_REFRESH_INTERVAL <= 0:
+        logger.info("REFERENCE_REFRESH_INTERVAL 為 0，不啟動背景更新")
+        return
+    import schedule
+    scheduler = schedule.Scheduler()
+    scheduler.every(REFERENCE_REFRESH_INTERVAL).to(
+        REFERENCE_REFRESH_INTERVAL + REFERENCE_REFRESH_JITTER
+    ).seconds.do(refresh_reference_data)
+    Thread(target=_run_reference_scheduler, args=(scheduler,), name="reference-refresher", daemon=True).start()
+
+def _run_reference_scheduler(scheduler):
+    while True:
+        try:
+            scheduler.run_pending()
+        except Exception as e:
+            logger.error(f"❌ 參考資料背景更新失敗：{e}", exc_info=True)
+        time.sleep(1)
 
 def process_booking(event, booking_category, booking_service, booking_date, booking_time, user_id, member_name):
     try:
-        client = get_gspread_client()
-        sheet = client.open_by_key(SPREADSHEET_KEY).worksheet("預約選項")
         booking_data = [user_id, member_name, booking_category, booking_service, booking_date, booking_time]
-        sheet.append_row(booking_data)
-        line_bot_api.push_message(user_id, TextSendMessage(text=f"✅ 您的 {booking_category} - {booking_service} 預約已成功記錄！"))
+        booking_id = booking_journal.record(SPREADSHEET_KEY, "預約選項", booking_data, user_id)
+        if booking_journal.flush_now(booking_id):
+            text = f"✅ 您的 {booking_category} - {booking_service} 預約已成功記錄！"
+        else:
+            text = f"📨 已收到您的 {booking_category} - {booking_service} 預約，正在處理中；若最後仍無法記錄會再通知您。"
+        push_dispatcher.send(user_id, TextSendMessage(text=text))
     except Exception as e:
         logger.error(f"儲存預約資料到 Google Sheets 失敗：{e}", exc_info=True)
-        line_bot_api.push_message(user_id, TextSendMessage(text="⚠ 儲存預約資料時發生錯誤，請稍後再試。"))
+        push_dispatcher.send(user_id, TextSendMessage(text="⚠ 儲存預約資料時發生錯誤，請稍後再試。"))
+
+# 預約流程的狀態與轉換（所有使用者共用）
+BOOKING_STATES = [
+    'start_booking',
+    'category_selection',
+    'expertise_selection',   # 新增：私人教練專長
+    'coach_selection',       # 新增：教練姓名
+    'service_selection',
+    'date_input',
+    'time_input',
+    'confirmation',
+    'completed',
+    'cancelled'
+]
+BOOKING_FLOW = [
+    # continue_booking 實際會處理的狀態順序，next_state/go_back 依此前進或後退
+    'start_booking',
+    'category_selection',
+    'service_selection',
+    'date_input',
+    'time_input',
+    'confirmation'
+]
+BOOKING_TRANSITIONS = [
+    {'trigger': 'start', 'source': 'start_booking', 'dest': 'category_selection', 'after': 'ask_category'},
+    # 根據是否為私人教練，走不同流程
+    {'trigger': 'select_category', 'source': 'category_selection', 'dest': 'expertise_selection',
+     'conditions': 'is_personal_coach_category', 'after': 'process_category'},
+    {'trigger': 'select_category', 'source': 'category_selection', 'dest': 'service_selection',
+     'unless': 'is_personal_coach_category', 'after': 'process_category'},
+    # 專長 → 教練 → 項目（實際上選完教練就可以定義 service）
+    {'trigger': 'select_expertise', 'source': 'expertise_selection', 'dest': 'coach_selection', 'after': 'ask_coach_name'},
+    {'trigger': 'select_coach', 'source': 'coach_selection', 'dest': 'date_input', 'after': 'ask_date'},
+    # 非私人教練的流程：項目 → 日期
+    {'trigger': 'select_service', 'source': 'service_selection', 'dest': 'date_input', 'after': 'ask_date'},
+    {'trigger': 'enter_date', 'source': 'date_input', 'dest': 'time_input', 'after': 'ask_time'},
+    {'trigger': 'enter_time', 'source': 'time_input', 'dest': 'confirmation', 'after': 'process_time'},
+    {'trigger': 'confirm_booking', 'source': 'confirmation', 'dest': 'completed', 'after': 'process_booking'},
+    {'trigger': 'cancel_booking', 'source': '*', 'dest': 'cancelled', 'after': 'send_cancellation_message'},
+    {'trigger': 'restart_booking', 'source': '*', 'dest': 'start_booking', 'after': 'send_booking_start_message'}
+]
+
+
+class BookingTransitionError(Exception):
+    pass
+
+def compile_transitions(transitions):
+    # 預先編譯成 trigger -> 來源狀態 -> [(目的狀態, conditions, unless, after)]，所有使用者共用同一份
+    table = {}
+    for transition in transitions:
+        sources = transition['source'] if isinstance(transition['source'], list) else [transition['source']]
+        conditions = transition.get('conditions', ())
+        unless = transition.get('unless', ())
+        entry = (
+            transition['dest'],
+            (conditions,) if isinstance(conditions, str) else tuple(conditions),
+            (unless,) if isinstance(unless, str) else tuple(unless),
+            transition.get('after')
+        )
+        for source in sources:
+            table.setdefault(transition['trigger'], {}).setdefault(source, []).append(entry)
+    return table
+
+BOOKING_TRANSITION_TABLE = compile_transitions(BOOKING_TRANSITIONS)
+
+def draw_booking_flow(path="booking_flow.png"):
+    # 只在開發時畫流程圖；正式環境不載入 transitions 的圖形套件
+    from transitions.extensions import GraphMachine
+    machine = GraphMachine(
+        states=BOOKING_STATES,
+        transitions=[{key: t[key] for key in ('trigger', 'source', 'dest')} for t in BOOKING_TRANSITIONS],
+        initial='start_booking'
+    )
+    machine.get_graph().draw(path, prog="dot")
 
-class BookingFSM(GraphMachine):
-    def __init__(self, user_id, **configs):
+class BookingFSM:
+    # 每個使用者只有一筆精簡的 __slots__ 紀錄，轉換規則查共用的 BOOKING_TRANSITION_TABLE
+    __slots__ = (
+        "user_id", "member_name", "state",
+        "booking_category", "booking_service", "booking_date", "booking_time",
+        "selected_service", "selected_expertise", "coach_specialty", "temp_data"
+    )
+
+    def __init__(self, user_id, initial='start_booking'):
         self.user_id = user_id
         self.member_name = ""
-        super().__init__(**configs)
+        self.state = initial
         self.reset_booking_data()
 
+    def trigger(self, trigger_name, *args):
+        candidates = BOOKING_TRANSITION_TABLE.get(trigger_name, {})
+        for dest, conditions, unless, after in candidates.get(self.state, ()) or candidates.get('*', ()):
+            if all(getattr(self, name)(*args) for name in conditions) and not any(getattr(self, name)(*args) for name in unless):
+                self.state = dest
+                if after:
+                    getattr(self, after)(*args)
+                return True
+        if not candidates.get(self.state) and not candidates.get('*'):
+            raise BookingTransitionError(f"無法在狀態 {self.state} 觸發 {trigger_name}")
+        return False
+
+    def next_state(self):
+        if self.state in BOOKING_FLOW[:-1]:
+            self.state = BOOKING_FLOW[BOOKING_FLOW.index(self.state) + 1]
+
+    def go_back(self, steps=1):
+        if self.state in BOOKING_FLOW:
+            self.state = BOOKING_FLOW[max(BOOKING_FLOW.index(self.state) - steps, 0)]
+
     def reset_booking_data(self):
         self.booking_category = None
         self.booking_service = None
         self.booking_date = None
         self.booking_time = None
 
+    def to_session(self):
+        # 只保存精簡的流程資料，讓其他執行個體也能接續預約流程
+        data = {
+            "fsm": self.state,
+            "category": self.booking_category,
+            "service": getattr(self, "selected_service", None) or self.booking_service,
+            "date": format_booking_date(self.booking_date) if self.booking_date else None,
+            "time": self.booking_time.strftime("%H:%M") if hasattr(self.booking_time, "strftime") else self.booking_time,
+            "member_name": self.member_name
+        }
+        if hasattr(self, "coach_specialty"):
+            data["specialty"] = self.coach_specialty
+        return data
+
+    @classmethod
+    def from_session(cls, user_id, data):
+        fsm = cls(user_id, initial=data["fsm"])
+        fsm.member_name = data.get("member_name") or ""
+        fsm.booking_category = data.get("category")
+        fsm.booking_service = data.get("service")
+        if data.get("service"):
+            fsm.selected_service = data["service"]
+        fsm.booking_date = parse_session_date(data.get("date"))
+        fsm.booking_time = parse_session_time(data.get("time"))
+        if fsm.booking_category == "預約私人教練":
+            # temp_data 不存進 session，依預約選項重建；選專長前也需要，select_service 會寫入教練列表
+            specialties = booking_options["categories"].get(fsm.booking_category, {}).get("專長", {})
+            fsm.temp_data = {"專長列表": list(specialties)}
+            if data.get("specialty"):
+                fsm.coach_specialty = data["specialty"]
+                fsm.temp_data["教練列表"] = specialties.get(data["specialty"], [])
+        return fsm
+
     def ask_category(self, event):
         global booking_options
         categories = list(booking_options["categories"].keys())
-        logger.info(f"ask_category 函數被呼叫，目前 booking_options: {booking_options}")  # 新增日誌
+        logger.info(f"ask_category 函數被呼叫，目前可預約類別：{categories}")
         if not categories:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="目前沒有可預約的類別，請稍後再試。"))
+            send_reply(event, TextSendMessage(text="目前沒有可預約的類別，請稍後再試。"))
             self.go_back()
             return  # 確保在沒有類別時，函數在這裡結束
         else:
@@ -138,7 +901,7 @@ class BookingFSM(GraphMachine):
                     actions=buttons
                 )
             )
-            line_bot_api.reply_message(event.reply_token, template)
+            send_reply(event, template)
 
     def process_category(self, event):
         self.booking_category = event.message.text
@@ -149,8 +912,8 @@ class BookingFSM(GraphMachine):
 
         if not services:
             logger.warning(f"[FSM] 找不到任何服務選項 for 類別：{self.booking_category}")
-            line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text=f"❌ {self.booking_category} 目前沒有任何可預約項目，請稍後再試。")
             )
             self.go_back()
@@ -172,7 +935,7 @@ class BookingFSM(GraphMachine):
                         actions=buttons
                     )
                 )
-                line_bot_api.reply_message(event.reply_token, template)
+                send_reply(event, template)
             else:
                 self.ask_service(event, specialties, prompt="請選擇教練專長")
             self.state = "service_selection"  # 等待使用者選擇專長
@@ -181,7 +944,7 @@ class BookingFSM(GraphMachine):
     # ✅ 處理單層結構（場地租借、團體課程）
         items = services.get("items", [])
         if not items:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 沒有可用的選項，請稍後再試。"))
+            send_reply(event, TextSendMessage(text="⚠️ 沒有可用的選項，請稍後再試。"))
             self.go_back()
             return
 
@@ -195,12 +958,10 @@ class BookingFSM(GraphMachine):
                     actions=buttons
                 )
             )
-            line_bot_api.reply_message(event.reply_token, template)
+            send_reply(event, template)
         else:
             self.ask_service(event, items)
 
-        self.next_state()
-
     def is_group_course_category(self, event):
         return event.message.text == "預約團體課程"
 
@@ -222,8 +983,8 @@ class BookingFSM(GraphMachine):
             self.ask_date(event)
             self.next_state()
         else:
-            line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text=f"抱歉，'{self.booking_category}' 類別下沒有 '{self.booking_service}' 這個項目，請重新選擇。")
             )
             self.go_back()
@@ -236,8 +997,8 @@ class BookingFSM(GraphMachine):
         }
         sheet_name = sheet_mapping.get(category)
         if not sheet_name:
-            self.line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text='無效的類別，請重新選擇。')
             )
             return
@@ -246,8 +1007,8 @@ class BookingFSM(GraphMachine):
         services = worksheet.col_values(1)[1:]  # 跳過標題列
 
         if not services:
-            self.line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text='找不到服務選項，請稍後再試。')
             )
             return
@@ -272,7 +1033,7 @@ class BookingFSM(GraphMachine):
             template=CarouselTemplate(columns=columns)
         )
 
-        self.line_bot_api.reply_message(event.reply_token, template_message)
+        send_reply(event, template_message)
     def select_service(self, event):
         user_input = event.message.text
 
@@ -283,7 +1044,7 @@ class BookingFSM(GraphMachine):
         # 如果還沒選擇專長 → 那這次是選擇「專長」
             if not hasattr(self, 'coach_specialty'):
                 if user_input not in services:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 無效的專長選項，請重新選擇。"))
+                    send_reply(event, TextSendMessage(text="❌ 無效的專長選項，請重新選擇。"))
                     return
                 self.coach_specialty = user_input  # 儲存專長
                 coach_list = services[user_input]
@@ -300,7 +1061,7 @@ class BookingFSM(GraphMachine):
                             actions=buttons
                         )
                     )
-                    line_bot_api.reply_message(event.reply_token, template)
+                    send_reply(event, template)
                 else:
                     self.ask_service(event, coach_list, prompt="請選擇教練姓名")
 
@@ -312,7 +1073,7 @@ class BookingFSM(GraphMachine):
                 self.next_state()
                 self.ask_date(event)
             else:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 無效的教練姓名，請重新選擇。"))
+                send_reply(event, TextSendMessage(text="❌ 無效的教練姓名，請重新選擇。"))
                 return
 
         else:
@@ -323,23 +1084,30 @@ class BookingFSM(GraphMachine):
                 self.next_state()
                 self.ask_date(event)
             else:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 無效的預約項目，請重新選擇。"))
+                send_reply(event, TextSendMessage(text="❌ 無效的預約項目，請重新選擇。"))
 
     def ask_date(self, event):
-        if self.booking_category == "團體課程":
+        if self.booking_category == "預約團體課程":
             message = "📅 請輸入欲上課的日期（格式：YYYY-MM-DD），請確認是否落在該課程的開課與結束日期之間。"
         else:
             message = "📅 請輸入預約日期（格式：YYYY-MM-DD）："
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=message))
+        send_reply(event, TextSendMessage(text=message))
 
     def enter_date(self, event):
-        self.booking_date = event.message.text.strip()
+        user_input = event.message.text.strip()
+        try:
+            self.booking_date = datetime.strptime(user_input.replace("/", "-"), "%Y-%m-%d").date()
+        except ValueError:
+            # 日期無效就停在輸入日期的步驟，否則後面的時間檢查無法組出預約時間
+            logger.warning(f"[FSM] 日期格式錯誤：{user_input}")
+            send_reply(event, TextSendMessage(text="❌ 日期格式錯誤，請輸入 YYYY-MM-DD，例如 2025-05-01"))
+            return
         logger.info(f"[FSM] 使用者輸入日期：{self.booking_date}")
         self.ask_time(event)
         self.next_state()
 
     def ask_time(self, event):
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入預約時間 (HH:MM)。"))
+        send_reply(event, TextSendMessage(text="請輸入預約時間 (HH:MM)。"))
 
     def enter_time(self, event):
         user_input = event.message.text.strip()
@@ -352,8 +1120,8 @@ class BookingFSM(GraphMachine):
         # 檢查是否早於現在時間
             now = datetime.now()
             if booking_datetime < now:
-                line_bot_api.reply_message(
-                    event.reply_token,
+                send_reply(
+                    event,
                     TextSendMessage(text="❌ 無法預約過去的時間，請重新輸入。")
                 )
                 return
@@ -363,58 +1131,49 @@ class BookingFSM(GraphMachine):
             if not sheet_name:
                 raise ValueError("無法對應的工作表")
 
-            column_name = "時間"
-            date_column = "日期"
-            target_column = None
-
-        # 團體課程不做衝突檢查
-            if self.booking_category == "團體課程":
+        # 團體課程不做衝突檢查；教練/場地依 BOOKING_TARGET_COLUMNS 找出要比對的欄位
+            if self.booking_category == "預約團體課程":
                 self.booking_time = booking_time
                 self.next_state()
+                self.confirm_booking(event)
                 return
-            elif self.booking_category == "私人教練":
-                target_column = "教練姓名"
-                target_value = self.selected_service
-            elif self.booking_category == "場地租借":
-                target_column = "場地"
-                target_value = self.selected_service
-            else:
+            target_column = BOOKING_TARGET_COLUMNS.get(self.booking_category)
+            if not target_column:
                 raise ValueError("未知的預約類別")
-
-        # 檢查衝突：讀取現有預約資料
-            client = get_gspread_client()
-            sheet = client.open_by_key(SPREADSHEET_KEY).worksheet(sheet_name)
-            records = sheet.get_all_records()
-
-            conflict_found = False
-            for row in records:
-                if (row.get(date_column) == self.booking_date.strftime("%Y-%m-%d") and
-                    row.get(target_column) == target_value and
-                    row.get(column_name)):
-
-                    existing_time = datetime.strptime(row[column_name], "%H:%M").time()
-                    existing_dt = datetime.combine(self.booking_date, existing_time)
-
-                # 若時間差小於 2 小時，視為衝突
-                    if abs((booking_datetime - existing_dt).total_seconds()) < 2 * 3600:
-                        conflict_found = True
-                        break
+            target_value = self.selected_service
+
+        # 檢查衝突：以 (教練/場地, 日期) 的排序時段索引做二分搜尋
+            conflict_found = booking_index.has_conflict(
+                sheet_name,
+                target_column,
+                target_value,
+                self.booking_date.strftime("%Y-%m-%d"),
+                booking_time.hour * 60 + booking_time.minute
+            )
 
             if conflict_found:
-                line_bot_api.reply_message(
-                    event.reply_token,
+                send_reply(
+                    event,
                     TextSendMessage(text="❌ 此時間已有人預約，請選擇距離他人至少 2 小時的時間。")
                 )
             else:
                 self.booking_time = booking_time
                 self.next_state()
+                self.confirm_booking(event)
 
         except ValueError:
             logger.warning(f"[FSM] 時間格式錯誤：{user_input}")
-            line_bot_api.reply_message(
-                event.reply_token,
+            send_reply(
+                event,
                 TextSendMessage(text="❌ 時間格式錯誤，請輸入 HH:MM，例如 13:00")
             )
+        except Exception as e:
+            # 試算表暫時無法讀取（含斷路中）時無法確認時段，保留在輸入時間的步驟讓使用者稍後重試
+            logger.error(f"[FSM] 預約時段檢查失敗：{e}", exc_info=True)
+            send_reply(
+                event,
+                TextSendMessage(text="⚠ 目前無法確認時段是否可預約，請稍後再輸入一次時間。")
+            )
 
     def process_time(self, event):
         self.booking_time = event.message.text
@@ -426,7 +1185,7 @@ class BookingFSM(GraphMachine):
             f"時間：{self.booking_time}\n\n"
             "輸入 '確認' 以完成預約，或輸入 '取消' 以取消。"
         )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=confirmation_text))
+        send_reply(event, TextSendMessage(text=confirmation_text))
         self.next_state()
 
     def confirm_booking(self, event):
@@ -439,29 +1198,18 @@ class BookingFSM(GraphMachine):
             f"時間：{self.booking_time}\n\n"
             "輸入『確認』以完成預約，或輸入『取消』以取消。"
         )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
+        send_reply(event, TextSendMessage(text=msg))
 
     def process_booking(self, event):
         if event.message.text.lower() == "確認":
             try:
-                client = get_gspread_client()
                 spreadsheet_key = (
                     SPREADSHEET_KEY  # 您的主要試算表 Key (假設所有資料在同一個試算表的不同工作表)
                 )
 
-                # 定義類別與試算表工作表名稱的對應關係
-                category_to_sheet = {
-                    "預約團體課程": "課程資料",
-                    "預約私人教練": "教練資料",
-                    "場地租借": "場地資料",
-                }
-
-                worksheet_name = category_to_sheet.get(self.booking_category)
+                worksheet_name = BOOKING_SHEET_MAPPING.get(self.booking_category)
 
                 if worksheet_name:
-                    sheet = client.open_by_key(spreadsheet_key).worksheet(
-                        worksheet_name
-                    )
                     booking_data = [
                         self.user_id,
                         self.booking_category,
@@ -469,13 +1217,22 @@ class BookingFSM(GraphMachine):
                         self.booking_date,
                         self.booking_time,
                     ]
-                    sheet.append_row(booking_data)
-                    line_bot_api.push_message(
-                        self.user_id,
-                        TextSendMessage(text=f"✅ 您的 {self.booking_category} 預約已成功記錄！"),
+                    booking_id = booking_journal.record(spreadsheet_key, worksheet_name, booking_data, self.user_id)
+                    booking_index.record_booking(
+                        booking_id,
+                        worksheet_name,
+                        self.booking_category,
+                        getattr(self, "selected_service", None) or self.booking_service,
+                        self.booking_date,
+                        self.booking_time
                     )
+                    if booking_journal.flush_now(booking_id):
+                        text = f"✅ 您的 {self.booking_category} 預約已成功記錄！"
+                    else:
+                        text = f"📨 已收到您的 {self.booking_category} 預約，正在處理中；若最後仍無法記錄會再通知您。"
+                    push_dispatcher.send(self.user_id, TextSendMessage(text=text))
                 else:
-                    line_bot_api.push_message(
+                    push_dispatcher.send(
                         self.user_id,
                         TextSendMessage(text="⚠ 無法確定要將此預約記錄到哪個工作表。"),
                     )
@@ -483,7 +1240,7 @@ class BookingFSM(GraphMachine):
 
             except Exception as e:
                 logger.error(f"儲存預約資料到 Google Sheets 失敗：{e}", exc_info=True)
-                line_bot_api.push_message(
+                push_dispatcher.send(
                     self.user_id,
                     TextSendMessage(text="⚠ 儲存預約資料時發生錯誤，請稍後再試。"),
                 )
@@ -496,13 +1253,13 @@ class BookingFSM(GraphMachine):
         elif event.message.text.lower() == "取消":
             self.trigger("cancel_booking", event)
         else:
-            line_bot_api.reply_message(
-                event.reply_token, TextSendMessage(text="請輸入 '確認' 或 '取消'。")
+            send_reply(
+                event, TextSendMessage(text="請輸入 '確認' 或 '取消'。")
             )
 
     def send_cancellation_message(self, event):
-        line_bot_api.reply_message(
-            event.reply_token, TextSendMessage(text="❌ 您的預約已取消。")
+        send_reply(
+            event, TextSendMessage(text="❌ 您的預約已取消。")
         )
         if self.user_id in user_states:
             del user_states[self.user_id]
@@ -510,19 +1267,28 @@ class BookingFSM(GraphMachine):
         self.go_back(2)  # 回到初始狀態 (start_booking)
 
     def send_booking_start_message(self, event):
-        line_bot_api.reply_message(
-            event.reply_token, TextSendMessage(text="好的，請按照步驟完成預約。")
+        send_reply(
+            event, TextSendMessage(text="好的，請按照步驟完成預約。")
         )
         self.next_state()  # 切換到 category_selection
 
+def _make_trigger(trigger_name):
+    def fire(self, *args):
+        return self.trigger(trigger_name, *args)
+    fire.__name__ = trigger_name
+    return fire
+
+# 與 transitions 相同：類別已有同名方法時不覆蓋（select_service、enter_date 等由方法本身處理）
+for _trigger_name in BOOKING_TRANSITION_TABLE:
+    if not hasattr(BookingFSM, _trigger_name):
+        setattr(BookingFSM, _trigger_name, _make_trigger(_trigger_name))
+
 def ask_coach_name(self, event):
     self.selected_expertise = event.message.text.strip()
     logger.info(f"[FSM] 使用者選擇的教練專長：{self.selected_expertise}")
 
     try:
-        client = get_gspread_client()
-        sheet = client.open_by_key(SPREADSHEET_KEY).worksheet("私人教練")
-        records = sheet.get_all_records()
+        records = fetch_records(SPREADSHEET_KEY, "私人教練")
 
         coach_list = sorted(set(
             row["教練姓名"] for row in records
@@ -544,12 +1310,12 @@ def ask_coach_name(self, event):
                     actions=buttons
                 )
             )
-            line_bot_api.reply_message(event.reply_token, template)
+            send_reply(event, template)
 
         self.next_state()
     except Exception as e:
         logger.error(f"❌ 載入教練清單失敗：{e}", exc_info=True)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 找不到對應的教練，請稍後再試。"))
+        send_reply(event, TextSendMessage(text="❌ 找不到對應的教練，請稍後再試。"))
         self.go_back()
 
 def is_personal_coach_category(self):
@@ -558,1002 +1324,2636 @@ def is_personal_coach_category(self):
 def set_selected_coach(self, event):
     self.selected_service = event.message.text.strip()
     self.next_state()
+# 🔑 Google Sheets 連線：每個行程只授權一次，並重複使用已開啟的試算表
+# gspread 與 google-auth 載入就要幾百毫秒，等第一次真的要讀試算表時才匯入，不拖慢冷啟動
+_gspread_lock = Lock()
+_gspread_client = None
+_gspread_credentials = None
+_spreadsheets = {}
+_worksheets = {}
+
 def get_gspread_client():
-    credentials_content = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_CONTENT")
-    if not credentials_content:
-        logger.error("缺少 GOOGLE_APPLICATION_CREDENTIALS_CONTENT 環境變數")
-        raise ValueError("環境變數未設定")
+    global _gspread_client, _gspread_credentials
+    if _gspread_client is not None:
+        return _gspread_client
+    with _gspread_lock:
+        if _gspread_client is None:
+            credentials_content = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_CONTENT")
+            if not credentials_content:
+                logger.error("缺少 GOOGLE_APPLICATION_CREDENTIALS_CONTENT 環境變數")
+                raise ValueError("環境變數未設定")
+            try:
+                import gspread
+                from google.oauth2.service_account import Credentials
+                from google.auth.transport.requests import AuthorizedSession
+                creds = Credentials.from_service_account_info(
+                    json.loads(credentials_content),
+                    scopes=GSPREAD_SCOPES
+                )
+                # 429/5xx 交給 sheets_reads 處理（有退避與統計），傳輸層只重試連線失敗
+                session = get_http_session("sheets", lambda: AuthorizedSession(creds), retry_statuses=())
+                _gspread_client = gspread.authorize(creds, session=session)
+                _gspread_client.set_timeout((HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+                _gspread_credentials = creds
+            except Exception as e:
+                logger.error(f"Google Sheets 授權錯誤：{e}", exc_info=True)
+                raise
+            Thread(target=_refresh_google_token_loop, name="google-token-refresher", daemon=True).start()
+    return _gspread_client
+
+def _refresh_google_token_loop():
+    # 在權杖過期前於背景更新，避免使用者請求自己去換發權杖
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    while True:
+        creds = _gspread_credentials
+        try:
+            expiry = creds.expiry
+            if not creds.valid or expiry is None or expiry - datetime.utcnow() < timedelta(seconds=GOOGLE_TOKEN_REFRESH_MARGIN):
+                creds.refresh(GoogleAuthRequest(session=get_http_session("google-auth")))
+                logger.info(f"🔑 Google 存取權杖已更新，到期時間：{creds.expiry}")
+            wait = (creds.expiry - datetime.utcnow()).total_seconds() - GOOGLE_TOKEN_REFRESH_MARGIN
+        except Exception as e:
+            logger.warning(f"Google 存取權杖更新失敗，稍後重試：{e}")
+            wait = 30
+        time.sleep(max(wait, 30))
+
+def open_spreadsheet(spreadsheet_key):
+    spreadsheet = _spreadsheets.get(spreadsheet_key)
+    if spreadsheet is None:
+        client = get_gspread_client()
+        with _gspread_lock:
+            spreadsheet = _spreadsheets.get(spreadsheet_key)
+            if spreadsheet is None:
+                spreadsheet = sheets_breaker.call(lambda: client.open_by_key(spreadsheet_key))
+                _spreadsheets[spreadsheet_key] = spreadsheet
+    return spreadsheet
+
+def get_worksheet(spreadsheet_key, sheet_name):
+    worksheet = _worksheets.get((spreadsheet_key, sheet_name))
+    if worksheet is None:
+        spreadsheet = open_spreadsheet(spreadsheet_key)
+        worksheet = sheets_breaker.call(lambda: spreadsheet.worksheet(sheet_name))
+        _worksheets[(spreadsheet_key, sheet_name)] = worksheet
+    return worksheet
+
+# 🔌 Sheets 斷路器：連續失敗或過慢時暫停呼叫，直接回舊資料或快速失敗，不讓請求執行緒卡在逾時上
+class SheetsUnavailable(Exception):
+    def __init__(self, message="試算表服務暫時無法使用，請稍後再試"):
+        super().__init__(message)
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, slow_seconds, cooldown):
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.state = "closed"  # closed / open / half_open
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = Lock()
+        self._local = local()  # 同一執行緒內的巢狀呼叫（例如讀取時順便開啟工作表）只算外層一次
+        self.stats_counter = {"opened": 0, "rejected": 0, "slow_calls": 0, "failed_calls": 0}
+
+    def call(self, fn):
+        if getattr(self._local, "active", False):
+            return fn()
+        self._before_call()
+        self._local.active = True
+        started = time.monotonic()
+        try:
+            result = fn()
+        except SheetsUnavailable:
+            self._after_call(failed=None)  # 請求根本沒送到試算表，不能當成恢復
+            raise
+        except Exception as e:
+            self._after_call(failed=is_sheets_outage(e))
+            raise
+        finally:
+            self._local.active = False
+        elapsed = time.monotonic() - started
+        slow = elapsed > self.slow_seconds
+        if slow:
+            logger.warning(f"試算表呼叫耗時 {elapsed:.1f} 秒，超過 {self.slow_seconds} 秒")
+        self._after_call(failed=slow, slow=slow)
+        return result
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "half_open"  # 放這一個請求去試探，其他請求仍快速失敗
+                return
+            self.stats_counter["rejected"] += 1
+        raise SheetsUnavailable()
+
+    def _after_call(self, failed, slow=False):
+        with self._lock:
+            if slow:
+                self.stats_counter["slow_calls"] += 1
+            if failed is None:
+                if self.state == "half_open":
+                    self.state = "open"  # 沿用原本的斷路時間，下一個請求可以再試探
+                return
+            if not failed:
+                if self.state != "closed":
+                    logger.info("🔌 試算表已恢復，斷路器關閉")
+                self.state = "closed"
+                self._failures = 0
+                return
+            self.stats_counter["failed_calls"] += 1
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats_counter["opened"] += 1
+                    logger.error(f"🔌 試算表連續 {self._failures} 次失敗或過慢，斷路 {self.cooldown:.0f} 秒")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.stats_counter, state=self.state)
+
+def is_sheets_outage(e):
+    # 只有服務端問題才算斷路器的失敗；找不到工作表之類的錯誤與服務是否正常無關
+    import gspread
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, requests.RequestException)
+
+sheets_breaker = CircuitBreaker(SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_SLOW_SECONDS, SHEETS_BREAKER_COOLDOWN)
+
+# 🚦 Sheets 讀取閘道：同樣的讀取同時只發出一次，其餘等待共用結果；依配額限速，429/5xx 以指數退避重試
+class SheetsFlight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class SheetsReadGate:
+    def __init__(self, reads_per_minute, burst, max_retries):
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(reads_per_minute / 60, burst)
+        self._inflight = {}
+        self._lock = Lock()
+        self.stats_counter = {
+            "requests": 0, "coalesced": 0, "throttled": 0, "throttle_wait_seconds": 0.0, "retries": 0, "errors": 0
+        }
+
+    def read(self, key, fetch):
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = SheetsFlight()
+            else:
+                self.stats_counter["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._fetch(fetch)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+        return flight.result
+
+    def _fetch(self, fetch):
+        import gspread
+        for attempt in range(self.max_retries + 1):
+            waited = self._bucket.acquire()
+            with self._lock:
+                self.stats_counter["requests"] += 1
+                if waited:
+                    self.stats_counter["throttled"] += 1
+                    self.stats_counter["throttle_wait_seconds"] += waited
+            try:
+                return sheets_breaker.call(fetch)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if (status != 429 and status < 500) or attempt == self.max_retries:
+                    self._count("errors")
+                    raise
+                error = f"HTTP {status}"
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    self._count("errors")
+                    raise
+                error = str(e)
+            delay = min(2 ** attempt + random.random(), SHEETS_BACKOFF_MAX)
+            logger.warning(f"試算表讀取失敗（{error}），{delay:.1f} 秒後重試")
+            self._count("retries")
+            time.sleep(delay)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counter[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.stats_counter, throttle_wait_seconds=round(self.stats_counter["throttle_wait_seconds"], 3))
+
+sheets_reads = SheetsReadGate(SHEETS_READS_PER_MINUTE, SHEETS_READ_BURST, SHEETS_MAX_RETRIES)
+
+def fetch_records(spreadsheet_key, sheet_name):
+    columns = SHEET_COLUMNS.get(sheet_name)
+    if columns:
+        return fetch_columns(spreadsheet_key, sheet_name, columns)
+    return sheets_reads.read(
+        ("records", spreadsheet_key, sheet_name),
+        lambda: get_worksheet(spreadsheet_key, sheet_name).get_all_records()
+    )
+
+# 📐 欄位投影與分段讀取：依表頭找出欄位所在的欄，只下載需要的欄與列
+_sheet_headers = {}  # (spreadsheet_key, sheet_name) -> 表頭
+
+def a1_sheet(sheet_name):
+    return "'" + sheet_name.replace("'", "''") + "'"
+
+def column_letter(index):
+    letters = ""
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def sheet_read_ranges(spreadsheet_key, sheet_name, columns=None, first_row=2, last_row=None):
+    # columns 為 None 時讀整張表；否則讀表頭列加上每個欄位各一段（表頭一起讀，用來確認欄位沒有被移動）
+    if columns is None:
+        return [a1_sheet(sheet_name)]
+    ranges = [f"{a1_sheet(sheet_name)}!1:1"]
+    header = _sheet_headers.get((spreadsheet_key, sheet_name))
+    if header is None:
+        return ranges  # 還不知道欄位位置，這次只讀表頭
+    for column in columns:
+        if column in header:
+            letter = column_letter(header.index(column) + 1)
+            ranges.append(f"{a1_sheet(sheet_name)}!{letter}{first_row}:{letter}{last_row or ''}")
+    return ranges
+
+def records_from_ranges(spreadsheet_key, sheet_name, columns, value_ranges):
+    # 表頭和上次不同（第一次讀或欄位有變動）時回傳 None，由呼叫端用新表頭重讀
+    from gspread.utils import numericise_all
+    if columns is None:
+        return records_from_values(value_ranges[0].get("values", []))
+    header_rows = value_ranges[0].get("values", []) if value_ranges else []
+    header = header_rows[0] if header_rows else []
+    if header != _sheet_headers.get((spreadsheet_key, sheet_name)):
+        _sheet_headers[(spreadsheet_key, sheet_name)] = header
+        return None
+    present = [column for column in columns if column in header]
+    values = {
+        column: numericise_all([row[0] if row else "" for row in value_range.get("values", [])], default_blank="")
+        for column, value_range in zip(present, value_ranges[1:])
+    }
+    row_count = max((len(column_values) for column_values in values.values()), default=0)
+    return [
+        {column: values[column][i] if column in values and i < len(values[column]) else "" for column in columns}
+        for i in range(row_count)
+    ]
+
+def batch_read(spreadsheet_key, specs):
+    # specs：{工作表: (欄位或 None, 起始列, 結束列)}，一次 values.batchGet 取回；回傳 {工作表: records}
+    results = {}
+    pending = dict(specs)
+    for _ in range(2):
+        plan = [(name, sheet_read_ranges(spreadsheet_key, name, *spec)) for name, spec in pending.items()]
+        ranges = [a1_range for _, sheet_ranges in plan for a1_range in sheet_ranges]
+        response = sheets_reads.read(
+            ("batch", spreadsheet_key, tuple(ranges)),
+            lambda: open_spreadsheet(spreadsheet_key).values_batch_get(ranges)
+        )
+        value_ranges = response.get("valueRanges", [])
+        retry = {}
+        offset = 0
+        for name, sheet_ranges in plan:
+            records = records_from_ranges(
+                spreadsheet_key, name, pending[name][0], value_ranges[offset:offset + len(sheet_ranges)]
+            )
+            offset += len(sheet_ranges)
+            if records is None:
+                retry[name] = pending[name]
+            else:
+                results[name] = records
+        if not retry:
+            break
+        pending = retry
+    return results
+
+def fetch_columns(spreadsheet_key, sheet_name, columns, first_row=2, last_row=None):
+    records = batch_read(spreadsheet_key, {sheet_name: (tuple(columns), first_row, last_row)}).get(sheet_name)
+    if records is None:
+        raise RuntimeError(f"工作表 {sheet_name} 的表頭一直在變動，無法讀取")
+    return records
+
+def iter_record_chunks(spreadsheet_key, sheet_name, columns, chunk_rows=SHEETS_CHUNK_ROWS):
+    # 分段讀取只會往下新增的大表（例如預約紀錄），一次只在記憶體保留一段；讀到不足一整段就是表尾
+    first_row = 2
+    while True:
+        last_row = first_row + chunk_rows - 1
+        records = fetch_columns(spreadsheet_key, sheet_name, columns, first_row, last_row)
+        if records:
+            yield records
+        if len(records) < chunk_rows:
+            return
+        first_row = last_row + 1
+
+# 📥 批次讀取：一份試算表的多張工作表用一次 values.batchGet 取回，再轉成 get_all_records 的格式
+def batch_get_records(spreadsheet_key, sheet_names):
+    import gspread
+    try:
+        return batch_read(spreadsheet_key, {name: (SHEET_COLUMNS.get(name), 2, None) for name in sheet_names})
+    except gspread.exceptions.APIError as e:
+        # 只要有一張工作表不存在整批就會失敗，改為逐張讀取
+        logger.warning(f"批次讀取失敗，改為逐張讀取：{e}")
+        results = {}
+        for name in sheet_names:
+            try:
+                results[name] = fetch_records(spreadsheet_key, name)
+            except gspread.exceptions.WorksheetNotFound:
+                logger.error(f"❌ 找不到工作表：{name}")
+        return results
+
+def records_from_values(values):
+    from gspread.utils import numericise_all
+    if not values:
+        return []
+    header = values[0]
+    records = []
+    for row in values[1:]:
+        row = row + [""] * (len(header) - len(row))
+        records.append(dict(zip(header, numericise_all(row, default_blank=""))))
+    return records
+
+# 👤 會員索引：會員編號雜湊表 + 姓名 n-gram 索引，工作表更新時只重建有變動的列
+def normalize_member_id(value):
+    return str(value).strip().upper()
+
+def normalize_member_name(value):
+    return unicodedata.normalize("NFKC", str(value)).strip().casefold()
+
+class MemberIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self._source = None  # 上次建立索引時的 records
+        self._rows = {}  # 列鍵 -> row
+        self._fingerprints = {}  # 列鍵 -> 內容指紋
+        self._ids = {}  # 會員編號 -> 列鍵
+        self._grams = {}  # 姓名 1/2-gram -> {列鍵}
+
+    def sync(self, records):
+        if records is self._source:
+            return
+        with self._lock:
+            if records is self._source:
+                return
+            seen = set()
+            for position, row in enumerate(records):
+                member_id = normalize_member_id(row.get("會員編號", ""))
+                row_key = member_id or f"#{position}"
+                seen.add(row_key)
+                fingerprint = tuple(row.items())
+                if self._fingerprints.get(row_key) == fingerprint:
+                    continue
+                self._remove(row_key)
+                self._add(row_key, member_id, row, fingerprint)
+            for row_key in [key for key in self._rows if key not in seen]:
+                self._remove(row_key)
+            self._source = records
+
+    def find_by_id(self, member_id):
+        row_key = self._ids.get(normalize_member_id(member_id))
+        return self._rows.get(row_key) if row_key else None
+
+    def search_name(self, keyword):
+        keyword = normalize_member_name(keyword)
+        if not keyword:
+            return []
+        grams = self._name_grams(keyword) if len(keyword) > 1 else {keyword}
+        with self._lock:
+            candidates = None
+            for gram in grams:
+                keys = self._grams.get(gram, set())
+                candidates = set(keys) if candidates is None else candidates & keys
+                if not candidates:
+                    return []
+            rows = [self._rows[key] for key in candidates]
+        return rank_member_matches(rows, keyword)
+
+    def _add(self, row_key, member_id, row, fingerprint):
+        self._rows[row_key] = row
+        self._fingerprints[row_key] = fingerprint
+        if member_id:
+            self._ids[member_id] = row_key
+        for gram in self._name_grams(normalize_member_name(row.get("姓名", ""))):
+            self._grams.setdefault(gram, set()).add(row_key)
+
+    def _remove(self, row_key):
+        row = self._rows.pop(row_key, None)
+        if row is None:
+            return
+        self._fingerprints.pop(row_key, None)
+        member_id = normalize_member_id(row.get("會員編號", ""))
+        if self._ids.get(member_id) == row_key:
+            del self._ids[member_id]
+        for gram in self._name_grams(normalize_member_name(row.get("姓名", ""))):
+            keys = self._grams.get(gram)
+            if keys:
+                keys.discard(row_key)
+                if not keys:
+                    del self._grams[gram]
+
+    @staticmethod
+    def _name_grams(name):
+        # 中文姓名多為 2~4 字，單字與雙字 gram 就能涵蓋任意子字串查詢
+        return set(name) | {name[i:i + 2] for i in range(len(name) - 1)}
+
+def rank_member_matches(rows, keyword):
+    # 完全相符 > 開頭相符 > 包含，同名次再依姓名長度與會員編號排序
+    matches = []
+    for row in rows:
+        name = normalize_member_name(row.get("姓名", ""))
+        if keyword not in name:
+            continue
+        rank = 0 if name == keyword else 1 if name.startswith(keyword) else 2
+        matches.append((rank, len(name), normalize_member_id(row.get("會員編號", "")), row))
+    matches.sort(key=lambda item: item[:3])
+    return [item[3] for item in matches]
+
+class ReadModelMembers:
+    # 與 MemberIndex 相同的查詢介面，資料改從本機查詢副本取
+    def __init__(self, model, table):
+        self.model = model
+        self.table = table
+
+    def find_by_id(self, member_id):
+        rows = self.model.select(self.table, 會員編號=member_id)
+        return rows[0] if rows else None
+
+    def search_name(self, keyword):
+        keyword = normalize_member_name(keyword)
+        if not keyword:
+            return []
+        return rank_member_matches(self.model.search(self.table, "姓名", keyword), keyword)
+
+member_indexes = {}
+
+def get_member_index(spreadsheet_key):
+    if read_model is not None and spreadsheet_key == MEMBER_SPREADSHEET_KEY:
+        table = read_model.table_for("member", "會員資料")
+        if read_model.is_ready(table):
+            return ReadModelMembers(read_model, table)
+    records = worksheet_cache.get_records(spreadsheet_key, "會員資料")
+    index = member_indexes.get(spreadsheet_key)
+    if index is None:
+        index = member_indexes.setdefault(spreadsheet_key, MemberIndex())
+    index.sync(records)
+    return index
+
+def pick_single_member(matches, keyword):
+    # 只有一筆，或姓名完全相符的只有一位時才直接採用
+    if len(matches) == 1:
+        return matches[0]
+    keyword = normalize_member_name(keyword)
+    exact = [row for row in matches if normalize_member_name(row.get("姓名", "")) == keyword]
+    return exact[0] if len(exact) == 1 else None
+
+def format_member_choices(matches):
+    lines = ["🔎 找到多位符合的會員，請輸入會員編號："]
+    for i, row in enumerate(matches[:MEMBER_MATCH_LIST_LIMIT], start=1):
+        lines.append(f"{i}. {row.get('姓名', '')}（{row.get('會員編號', '')}）")
+    if len(matches) > MEMBER_MATCH_LIST_LIMIT:
+        lines.append(f"…另有 {len(matches) - MEMBER_MATCH_LIST_LIMIT} 位，請輸入更完整的姓名")
+    return "\n".join(lines)
+
+# 📆 課程行事曆：把每門課的開始/結束日期與每週上課日展開成「日期 -> 課程」，查某天或本週都只要查表
+COURSE_WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6}
+COURSE_WEEKDAY_NAMES = "一二三四五六日"
+COURSE_WEEKDAY_RANGE_PREFIX = re.compile(r"([~至到-])\s*(?:週|周|星期|禮拜)")  # 「週一~週三」的第二個「週」
+COURSE_WEEKDAY_PATTERN = re.compile(r"(?:週|周|星期|禮拜)([一二三四五六日天](?:\s*[、,/~至到-]?\s*[一二三四五六日天])*)")
+
+def parse_course_date(value):
+    if hasattr(value, "year"):
+        return value
     try:
-        with tempfile.NamedTemporaryFile(mode="w+", delete=True, suffix=".json") as temp_file:
-            temp_file.write(credentials_content)
-            temp_file.flush()
-            scope = [
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive"
+        return datetime.strptime(str(value).strip().replace("/", "-"), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def parse_course_weekdays(value):
+    # 支援「每週一、三」「週二四」「星期一至五」「每天」等寫法，看不出星期時回傳空集合
+    text = unicodedata.normalize("NFKC", str(value))
+    if "每天" in text or "每日" in text:
+        return frozenset(range(7))
+    text = COURSE_WEEKDAY_RANGE_PREFIX.sub(r"\1", text)
+    weekdays = set()
+    for match in COURSE_WEEKDAY_PATTERN.finditer(text):
+        tokens = re.findall(r"[一二三四五六日天]|[~至到-]", match.group(1))
+        for i, token in enumerate(tokens):
+            if token in COURSE_WEEKDAYS:
+                weekdays.add(COURSE_WEEKDAYS[token])
+            elif 0 < i < len(tokens) - 1 and tokens[i + 1] in COURSE_WEEKDAYS:
+                first, last = COURSE_WEEKDAYS[tokens[i - 1]], COURSE_WEEKDAYS[tokens[i + 1]]
+                if first <= last:
+                    weekdays.update(range(first, last + 1))
+                else:
+                    weekdays.update(range(first, 7), range(0, last + 1))  # 跨週末，例如「週五至一」
+    return frozenset(weekdays)
+
+def course_days(row):
+    start = parse_course_date(row.get("開始日期", ""))
+    if start is None:
+        return []
+    end = parse_course_date(row.get("結束日期", ""))
+    if end is None or end <= start:
+        return [start]  # 沒有結束日期視為單次課程
+    span = min((end - start).days, COURSE_CALENDAR_MAX_DAYS)
+    days = [start + timedelta(days=offset) for offset in range(span + 1)]
+    # 看不出星期（例如只寫 19:00-21:00）時，視為每週與開課日同一天上課
+    weekdays = parse_course_weekdays(row.get("上課時間", "")) or {start.weekday()}
+    return [day for day in days if day.weekday() in weekdays]
+
+class CourseCalendar:
+    def __init__(self):
+        self._lock = Lock()
+        self._source = None  # 上次展開時的 records
+        self._rows = {}  # 列鍵 -> row
+        self._days = {}  # 列鍵 -> 該課程的上課日
+        self._positions = {}  # 列鍵 -> 在工作表中的順序
+        self._buckets = {}  # 日期 -> {列鍵}
+
+    def sync(self, records):
+        # 列鍵是列內容（同內容重複出現時加序號），只有新增/修改/刪除的課程需要重新展開
+        if records is self._source:
+            return
+        with self._lock:
+            if records is self._source:
+                return
+            positions = {}
+            occurrences = {}
+            added = 0
+            for position, row in enumerate(records):
+                fingerprint = tuple(row.items())
+                occurrence = occurrences[fingerprint] = occurrences.get(fingerprint, -1) + 1
+                row_key = (fingerprint, occurrence)
+                positions[row_key] = position
+                if row_key not in self._rows:
+                    self._add(row_key, row)
+                    added += 1
+            removed = [row_key for row_key in self._rows if row_key not in positions]
+            for row_key in removed:
+                self._remove(row_key)
+            self._positions = positions
+            self._source = records
+        if added or removed:
+            logger.info(f"📆 課程行事曆已更新：新增 {added} 筆、移除 {len(removed)} 筆課程，共 {len(self._buckets)} 個上課日")
+
+    def on_date(self, day):
+        with self._lock:
+            row_keys = sorted(self._buckets.get(day, ()), key=self._positions.get)
+            return [self._rows[row_key] for row_key in row_keys]
+
+    def week_of(self, day):
+        monday = day - timedelta(days=day.weekday())
+        return [(monday + timedelta(days=offset), self.on_date(monday + timedelta(days=offset))) for offset in range(7)]
+
+    def _add(self, row_key, row):
+        days = course_days(row)
+        self._rows[row_key] = row
+        self._days[row_key] = days
+        for day in days:
+            self._buckets.setdefault(day, set()).add(row_key)
+
+    def _remove(self, row_key):
+        self._rows.pop(row_key, None)
+        for day in self._days.pop(row_key, ()):
+            keys = self._buckets.get(day)
+            if keys:
+                keys.discard(row_key)
+                if not keys:
+                    del self._buckets[day]
+
+    def stats(self):
+        return {"courses": len(self._rows), "days": len(self._buckets)}
+
+course_calendar = CourseCalendar()
+
+def get_course_calendar():
+    course_calendar.sync(worksheet_cache.get_records(MEMBER_SPREADSHEET_KEY, "課程資料"))
+    return course_calendar
+
+@on_reference_change
+def rebuild_course_calendar(changed_sheets, changed_categories):
+    if "課程資料" in changed_sheets:
+        course_calendar.sync(reference_snapshot.sheets["課程資料"])
+
+# 📅 預約時段索引：每個 (工作表, 教練/場地, 日期) 保存排序好的開始時間（分鐘），衝突檢查用 bisect
+BOOKING_TARGET_COLUMNS = {
+    '私人教練': '教練姓名',
+    '預約私人教練': '教練姓名',
+    '場地租借': '場地'
+}
+
+def parse_booking_minutes(value):
+    if isinstance(value, timedelta):
+        return int(value.total_seconds() // 60)
+    if hasattr(value, "hour"):
+        return value.hour * 60 + value.minute
+    for time_format in ("%H:%M", "%H:%M:%S"):
+        try:
+            parsed = datetime.strptime(str(value).strip(), time_format)
+        except ValueError:
+            continue
+        return parsed.hour * 60 + parsed.minute
+    return None
+
+def format_booking_date(value):
+    return value.strftime("%Y-%m-%d") if hasattr(value, "strftime") else str(value).strip()
+
+class BookingIntervalIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._tables = {}  # (工作表, 欄位) -> {(教練/場地, 日期): [開始分鐘...]}
+        self._loaded_at = {}
+        self._rebuilding = set()  # 正在背景重建的 (工作表, 欄位)，同時只跑一個
+        self._pending = {}  # booking_id -> (工作表, 欄位, 教練/場地, 日期, 分鐘)：已收到、尚未寫進試算表的預約
+
+    def has_conflict(self, sheet_name, target_column, target_value, date_str, minutes, window=BOOKING_CONFLICT_MINUTES):
+        table = self._table(sheet_name, target_column)
+        slots = table.get((target_value, date_str))
+        if not slots:
+            return False
+        # 第一個晚於 (minutes - window) 的時段，只要早於 (minutes + window) 即重疊
+        i = bisect_right(slots, minutes - window)
+        return i < len(slots) and slots[i] < minutes + window
+
+    def add(self, booking_id, sheet_name, target_column, target_value, date_str, minutes):
+        if minutes is None or not target_value:
+            return
+        with self._lock:
+            self._pending[booking_id] = (sheet_name, target_column, target_value, date_str, minutes)
+            table = self._tables.get((sheet_name, target_column))
+            if table is not None:
+                insort(table.setdefault((target_value, date_str), []), minutes)
+
+    def record_booking(self, booking_id, sheet_name, booking_category, target_value, booking_date, booking_time):
+        target_column = BOOKING_TARGET_COLUMNS.get(booking_category)
+        if target_column:
+            self.add(
+                booking_id, sheet_name, target_column, target_value,
+                format_booking_date(booking_date), parse_booking_minutes(booking_time)
+            )
+
+    def confirm(self, booking_ids):
+        # 已寫進試算表：下次重建會從試算表讀到，不必再補回，避免重複計算
+        with self._lock:
+            for booking_id in booking_ids:
+                self._pending.pop(booking_id, None)
+
+    def discard(self, booking_ids):
+        # 日誌放棄寫入：時段不再佔用，同時從目前的表移除
+        with self._lock:
+            for booking_id in booking_ids:
+                slot = self._pending.pop(booking_id, None)
+                if slot is None:
+                    continue
+                sheet_name, target_column, target_value, date_str, minutes = slot
+                slots = self._tables.get((sheet_name, target_column), {}).get((target_value, date_str))
+                if slots and minutes in slots:
+                    slots.remove(minutes)
+
+    def _table(self, sheet_name, target_column):
+        # 第一次必須同步讀取；之後過期就先用手上的表，背景重建，失敗也繼續沿用上一版
+        key = (sheet_name, target_column)
+        with self._lock:
+            table = self._tables.get(key)
+            expired = table is not None and time.monotonic() - self._loaded_at[key] > self.ttl
+            refresh = expired and key not in self._rebuilding
+            if refresh:
+                self._rebuilding.add(key)
+        if table is None:
+            return self._rebuild(sheet_name, target_column)
+        if refresh:
+            Thread(target=self._refresh, args=key, name="booking-index-refresh", daemon=True).start()
+        return table
+
+    def _refresh(self, sheet_name, target_column):
+        try:
+            self._rebuild(sheet_name, target_column)
+        except Exception as e:
+            logger.warning(f"預約時段索引重建失敗（{sheet_name}），先沿用上一版：{e}")
+        finally:
+            with self._lock:
+                self._rebuilding.discard((sheet_name, target_column))
+
+    def _rebuild(self, sheet_name, target_column):
+        # 讀取前先記下尚未寫入的預約；讀取途中剛好寫入的會多算一次，只是暫時較保守，下次重建就會修正
+        with self._lock:
+            pending = [slot for slot in self._pending.values() if slot[:2] == (sheet_name, target_column)]
+        table = {}
+        # 預約紀錄只會越來越長：只讀日期、時間、教練/場地三欄，並分段處理
+        for records in iter_record_chunks(SPREADSHEET_KEY, sheet_name, ("日期", "時間", target_column)):
+            for row in records:
+                minutes = parse_booking_minutes(row.get("時間", ""))
+                target_value = row.get(target_column)
+                if minutes is None or not target_value:
+                    continue
+                table.setdefault((target_value, format_booking_date(row.get("日期", ""))), []).append(minutes)
+        for _, _, target_value, date_str, minutes in pending:
+            table.setdefault((target_value, date_str), []).append(minutes)
+        with self._lock:
+            for slots in table.values():
+                slots.sort()
+            self._tables[(sheet_name, target_column)] = table
+            self._loaded_at[(sheet_name, target_column)] = time.monotonic()
+        return table
+
+booking_index = BookingIntervalIndex(BOOKING_INDEX_TTL)
+
+# 📝 預約日誌：先寫入本機 SQLite（WAL），回覆前同步嘗試寫入試算表一次，失敗再由背景執行緒批次 append_rows 重試
+# 每筆預約帶 booking_id（寫在該列最後一欄），重試前先比對試算表，確保只寫入一次
+# ⚠ 在 Vercel 等 Serverless 環境，/tmp 只屬於單一執行個體，背景執行緒也會隨執行個體凍結或回收而停止：
+#   日誌不能當作持久保存，只有同步寫入成功的預約才算真正完成，其餘只回覆「已收到、處理中」
+def format_sheet_value(value):
+    # date/time 寫成與人工輸入相同的格式，預約時段索引重建時才讀得回來
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    if hasattr(value, "year"):
+        return value.strftime("%Y-%m-%d")
+    if hasattr(value, "hour"):
+        return value.strftime("%H:%M")
+    return value
+
+class BookingJournal:
+    def __init__(self, path, flush_interval, batch_size, max_attempts):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._lock = Lock()
+        self._wake = Event()
+        self._conn = None
+        self._started = False
+        self._flush_lock = Lock()  # 背景執行緒與同步寫入不可同時 flush，否則同一筆會 append 兩次
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bookings ("
+                " booking_id TEXT PRIMARY KEY,"
+                " spreadsheet_key TEXT NOT NULL,"
+                " worksheet TEXT NOT NULL,"
+                " row_json TEXT NOT NULL,"
+                " user_id TEXT,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL DEFAULT 0,"
+                " last_error TEXT,"
+                " created_at REAL NOT NULL,"
+                " flushed_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_pending ON bookings (status, next_attempt_at)")
+            self._conn = conn
+        return self._conn
+
+    def record(self, spreadsheet_key, worksheet, row, user_id=None):
+        booking_id = uuid.uuid4().hex
+        row = [format_sheet_value(value) for value in row]
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO bookings (booking_id, spreadsheet_key, worksheet, row_json, user_id, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (booking_id, spreadsheet_key, worksheet, json.dumps(row + [booking_id], ensure_ascii=False), user_id, time.time())
+            )
+        self._wake.set()
+        return booking_id
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        Thread(target=self._run, name="booking-journal-flusher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ 預約日誌寫入試算表失敗：{e}", exc_info=True)
+
+    def flush_now(self, booking_id):
+        # 回覆使用者前先同步寫入一次，回傳這筆預約是否已確實寫進試算表
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"預約同步寫入失敗，改由背景重試：{e}")
+        with self._lock:
+            row = self._connection().execute("SELECT status FROM bookings WHERE booking_id = ?", (booking_id,)).fetchone()
+        return bool(row) and row[0] == "flushed"
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending = self._connection().execute(
+                "SELECT booking_id, spreadsheet_key, worksheet, row_json, user_id, attempts FROM bookings"
+                " WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY created_at LIMIT ?",
+                (time.time(), self.batch_size)
+            ).fetchall()
+        groups = OrderedDict()
+        for item in pending:
+            groups.setdefault((item[1], item[2]), []).append(item)
+        for (spreadsheet_key, worksheet), items in groups.items():
+            self._flush_group(spreadsheet_key, worksheet, items)
+
+    def _flush_group(self, spreadsheet_key, worksheet, items):
+        booking_ids = [item[0] for item in items]
+        retried = any(item[5] > 0 for item in items)
+        # 先記下嘗試次數；若 append 成功後行程中斷，下次會走「先比對再寫」的路徑
+        self._execute_many(
+            "UPDATE bookings SET attempts = attempts + 1 WHERE booking_id = ?",
+            [(booking_id,) for booking_id in booking_ids]
+        )
+        try:
+            sheet = get_worksheet(spreadsheet_key, worksheet)
+            if retried:
+                ids = set(booking_ids)
+                values = sheets_reads.read(("values", spreadsheet_key, worksheet), sheet.get_all_values)
+                written = {cell for row in values for cell in row if cell in ids}
+                items = [item for item in items if item[0] not in written]
+            if items:
+                rows = [json.loads(item[3]) for item in items]
+                sheets_breaker.call(lambda: sheet.append_rows(rows, value_input_option="RAW"))  # 原樣寫入，不讓試算表依地區格式改寫日期時間
+            self._execute_many(
+                "UPDATE bookings SET status = 'flushed', flushed_at = ?, last_error = NULL WHERE booking_id = ?",
+                [(time.time(), booking_id) for booking_id in booking_ids]
+            )
+            booking_index.confirm(booking_ids)
+            logger.info(f"✅ 已將 {len(items)} 筆預約寫入 {worksheet}")
+        except Exception as e:
+            logger.warning(f"預約寫入 {worksheet} 失敗，稍後重試：{e}")
+            self._mark_failed(items, str(e))
+
+    def _mark_failed(self, items, error):
+        retry = []
+        failed = []
+        for booking_id, _, _, _, user_id, attempts in items:
+            if attempts + 1 >= self.max_attempts:
+                failed.append((booking_id, user_id))
+            else:
+                retry.append((error, time.time() + min(2 ** (attempts + 1), 300), booking_id))
+        self._execute_many(
+            "UPDATE bookings SET last_error = ?, next_attempt_at = ? WHERE booking_id = ?", retry
+        )
+        self._execute_many(
+            "UPDATE bookings SET status = 'failed', last_error = ? WHERE booking_id = ?",
+            [(error, booking_id) for booking_id, _ in failed]
+        )
+        booking_index.discard([booking_id for booking_id, _ in failed])
+        for booking_id, user_id in failed:
+            logger.error(f"❌ 預約 {booking_id} 多次寫入失敗，已放棄")
+            if user_id:
+                push_dispatcher.send(user_id, TextSendMessage(text="⚠ 儲存預約資料時發生錯誤，請稍後再試。"))
+
+    def _execute_many(self, sql, params):
+        if not params:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.executemany(sql, params)
+            conn.execute("COMMIT")
+
+    def stats(self):
+        with self._lock:
+            rows = self._connection().execute("SELECT status, COUNT(*) FROM bookings GROUP BY status").fetchall()
+        return dict(rows)
+
+booking_journal = BookingJournal(
+    BOOKING_JOURNAL_PATH,
+    BOOKING_FLUSH_INTERVAL,
+    BOOKING_FLUSH_BATCH_SIZE,
+    BOOKING_FLUSH_MAX_ATTEMPTS
+)
+
+# 📦 工作表快取：命中直接回傳，過期則先回舊資料並在背景更新
+class WorksheetCache:
+    def __init__(self, ttls, default_ttl, stale_ttl, max_entries):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (spreadsheet_key, sheet_name) -> (records, fetched_at, version)
+        self._refreshing = set()
+        self._version = 0
+        self._lock = Lock()
+
+    def get_records(self, spreadsheet_key, sheet_name):
+        return self.get_versioned(spreadsheet_key, sheet_name)[0]
+
+    def get_versioned(self, spreadsheet_key, sheet_name):
+        # 連同資料版本一起回傳；內容沒變的重新讀取不會換版本，依版本快取的結果可以繼續沿用
+        cache_key = (spreadsheet_key, sheet_name)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+                records, fetched_at, version = entry
+                age = time.monotonic() - fetched_at
+                ttl = self.ttls.get(sheet_name, self.default_ttl)
+                if age < ttl:
+                    return records, version
+                if age < ttl + self.stale_ttl:
+                    if cache_key not in self._refreshing:
+                        self._refreshing.add(cache_key)
+                        Thread(target=self._refresh, args=cache_key, daemon=True).start()
+                    return records, version
+        try:
+            return self._load(spreadsheet_key, sheet_name)
+        except Exception as e:
+            # 讀不到就退回最後一份成功的資料（不論多舊），由呼叫端決定要不要標示可能過期
+            with self._lock:
+                entry = self._entries.get(cache_key)
+            if entry is None:
+                raise
+            logger.warning(f"工作表 {sheet_name} 讀取失敗，改用 {time.monotonic() - entry[1]:.0f} 秒前的資料：{e}")
+            return entry[0], entry[2]
+
+    def age(self, spreadsheet_key, sheet_name):
+        entry = self._entries.get((spreadsheet_key, sheet_name))
+        return time.monotonic() - entry[1] if entry is not None else None
+
+    def is_fresh(self, spreadsheet_key, sheet_name):
+        age = self.age(spreadsheet_key, sheet_name)
+        return age is not None and age < self.ttls.get(sheet_name, self.default_ttl)
+
+    def put(self, spreadsheet_key, sheet_name, records):
+        # 一律存成 tuple，不同來源（批次讀取/單張讀取）的相同內容才比對得出來；
+        # 內容沒變就沿用原本的物件與版本，依物件身分或版本快取的索引、回覆都不必重建
+        cache_key = (spreadsheet_key, sheet_name)
+        records = tuple(records)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] == records:
+                records = entry[0]
+                version = entry[2]
+            else:
+                self._version += 1
+                version = self._version
+            self._entries[cache_key] = (records, time.monotonic(), version)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return records, version
+
+    def peek(self, spreadsheet_key, sheet_name):
+        # 不觸發讀取，只看目前手上的資料（可能已過期）
+        entry = self._entries.get((spreadsheet_key, sheet_name))
+        return entry[0] if entry is not None else None
+
+    def invalidate(self, spreadsheet_key, sheet_name):
+        with self._lock:
+            self._entries.pop((spreadsheet_key, sheet_name), None)
+
+    def _load(self, spreadsheet_key, sheet_name):
+        return self.put(spreadsheet_key, sheet_name, fetch_records(spreadsheet_key, sheet_name))
+
+    def _refresh(self, spreadsheet_key, sheet_name):
+        try:
+            self._load(spreadsheet_key, sheet_name)
+            logger.info(f"🔄 工作表快取已於背景更新：{sheet_name}")
+        except Exception as e:
+            logger.warning(f"工作表快取背景更新失敗（{sheet_name}），先沿用舊資料：{e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard((spreadsheet_key, sheet_name))
+
+worksheet_cache = WorksheetCache(
+    WORKSHEET_CACHE_TTL,
+    WORKSHEET_CACHE_DEFAULT_TTL,
+    WORKSHEET_CACHE_STALE_TTL,
+    WORKSHEET_CACHE_MAX_ENTRIES
+)
+
+# 🗄️ 本機查詢副本：把常用工作表同步到 SQLite，依分類/類型/日期/姓名/會員編號建索引，查詢不必掃整張表
+def read_model_value(column, value):
+    if column == "會員編號":
+        return normalize_member_id(value)
+    if column == "姓名":
+        return normalize_member_name(value)
+    return str(value).strip()
+
+class SheetReadModel:
+    def __init__(self, path, sources, sync_interval):
+        self.path = path
+        self.sources = sources
+        self.sync_interval = sync_interval
+        self.tables = {
+            (origin, sheet_name): table for table, (origin, sheet_name, _columns) in sources.items()
+        }
+        self._lock = Lock()
+        self._conn = None
+        self._versions = {}  # 資料表 -> 版本，每次內容替換加一
+        self._started = False
+        self.queries = 0
+        self.syncs = 0
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state ("
+                " table_name TEXT PRIMARY KEY,"
+                " content_hash TEXT NOT NULL,"
+                " row_count INTEGER NOT NULL,"
+                " synced_at REAL NOT NULL)"
+            )
+            for table, (_origin, _sheet_name, columns) in self.sources.items():
+                expected = ["row_no", "data", *columns]
+                existing = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+                if existing and existing != expected:
+                    # 索引欄位設定改過，舊表直接重建，下次同步會重新寫入
+                    conn.execute(f'DROP TABLE "{table}"')
+                    conn.execute("DELETE FROM sync_state WHERE table_name = ?", (table,))
+                column_defs = "".join(f', "{column}" TEXT' for column in columns)
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (row_no INTEGER PRIMARY KEY, data TEXT NOT NULL{column_defs})')
+                for column in columns:
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON "{table}" ("{column}")')
+            for table, in conn.execute("SELECT table_name FROM sync_state"):
+                self._versions[table] = 1  # 檔案裡已有上次同步的內容，重啟後可直接查詢
+            self._conn = conn
+        return self._conn
+
+    def table_for(self, origin, sheet_name):
+        return self.tables.get((origin, sheet_name))
+
+    def is_ready(self, table):
+        return table in self._versions
+
+    def version(self, table):
+        return self._versions.get(table)
+
+    def replace(self, table, records):
+        # 內容雜湊相同就不重寫；整張表在同一個交易內替換，查詢端不會看到寫到一半的資料
+        columns = self.sources[table][2]
+        digest = sheet_content_hash(records)
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT content_hash FROM sync_state WHERE table_name = ?", (table,)).fetchone()
+            if row and row[0] == digest:
+                self._versions.setdefault(table, 1)
+                return False
+            placeholders = ", ".join("?" * (len(columns) + 2))
+            column_names = "".join(f', "{column}"' for column in columns)
+            rows = [
+                (position, json.dumps(record, ensure_ascii=False, default=str),
+                 *(read_model_value(column, record.get(column, "")) for column in columns))
+                for position, record in enumerate(records)
             ]
-            creds = ServiceAccountCredentials.from_json_keyfile_name(temp_file.name, scope)
-            client = gspread.authorize(creds)
-            return client
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(f'DELETE FROM "{table}"')
+                conn.executemany(f'INSERT INTO "{table}" (row_no, data{column_names}) VALUES ({placeholders})', rows)
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (table_name, content_hash, row_count, synced_at) VALUES (?, ?, ?, ?)",
+                    (table, digest, len(rows), time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._versions[table] = self._versions.get(table, 0) + 1
+            self.syncs += 1
+        logger.info(f"🗄️ 本機查詢副本已更新：{table}（{len(rows)} 筆）")
+        return True
+
+    def select(self, table, **conditions):
+        columns = self.sources[table][2]
+        clauses = []
+        params = []
+        for column, value in conditions.items():
+            if column not in columns:
+                raise KeyError(f"{table} 沒有 {column} 的索引欄位")
+            clauses.append(f'"{column}" = ?')
+            params.append(read_model_value(column, value))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._connection().execute(f'SELECT data FROM "{table}"{where} ORDER BY row_no', params).fetchall()
+            self.queries += 1
+        return [json.loads(row[0]) for row in rows]
+
+    def search(self, table, column, keyword):
+        # 子字串查詢無法用索引，但比對的是已正規化的欄位，不必再解析每列 JSON
+        with self._lock:
+            rows = self._connection().execute(
+                f'SELECT data FROM "{table}" WHERE instr("{column}", ?) > 0 ORDER BY row_no',
+                (read_model_value(column, keyword),)
+            ).fetchall()
+            self.queries += 1
+        return [json.loads(row[0]) for row in rows]
+
+    def sync(self):
+        for table, (_source, sheet_name, _columns) in self.sources.items():
+            try:
+                # 經由工作表快取讀取，已有的資料不會重複向試算表下載
+                self.replace(table, worksheet_cache.get_records(MEMBER_SPREADSHEET_KEY, sheet_name))
+            except Exception as e:
+                logger.warning(f"本機查詢副本同步失敗（{table}），沿用上次內容：{e}")
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        Thread(target=self._run, name="read-model-sync", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.sync()
+            time.sleep(self.sync_interval)
+
+    def stats(self):
+        with self._lock:
+            tables = {
+                table: {"rows": row_count, "synced_at": datetime.fromtimestamp(synced_at).isoformat(timespec="seconds")}
+                for table, row_count, synced_at in self._connection().execute(
+                    "SELECT table_name, row_count, synced_at FROM sync_state"
+                )
+            }
+        return {"path": self.path, "tables": tables, "queries": self.queries, "syncs": self.syncs}
+
+read_model = SheetReadModel(READ_MODEL_PATH, READ_MODEL_SOURCES, READ_MODEL_SYNC_INTERVAL) if READ_MODEL_PATH else None
+
+# 🧱 預先建立的訊息：固定選單在啟動時建立並序列化一次，回覆時直接送出 JSON，不必每次重建物件
+class PrebuiltMessage:
+    __slots__ = ("messages", "payload")
+
+    def __init__(self, messages):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        if not 1 <= len(messages) <= 5:
+            raise ValueError(f"一次回覆需為 1～5 則訊息，收到 {len(messages)} 則")
+        self.messages = list(messages)
+        # 啟動時就序列化，格式有誤會在部署當下出錯，而不是等到使用者點選
+        self.payload = json.dumps(
+            [message.as_json_dict() for message in self.messages],
+            ensure_ascii=False, separators=(",", ":")
+        )
+
+    def body(self, field, value):
+        return f'{{{json.dumps(field)}:{json.dumps(value)},"messages":{self.payload}}}'.encode("utf-8")
+
+# 🗂️ 動態回覆快取：查詢結果只取決於指令、參數與工作表內容，資料版本沒變就直接送出上次組好的訊息
+class RenderCache:
+    def __init__(self, spreadsheet_key, max_entries):
+        self.spreadsheet_key = spreadsheet_key
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (render 名稱, 參數) -> (工作表, 資料版本, PrebuiltMessage)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, render, sheet_name, argument="", where=None):
+        # 啟用本機查詢副本時，只用索引撈出 where 條件符合的列交給 render，不必讀整張表
+        table = read_model.table_for("member", sheet_name) if read_model is not None else None
+        if table and read_model.is_ready(table):
+            records, version = None, ("read_model", read_model.version(table))
+        else:
+            records, version = worksheet_cache.get_versioned(self.spreadsheet_key, sheet_name)
+        cache_key = (render.__name__, argument)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[1] == version:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        if records is None:
+            records = read_model.select(table, **(where or {}))
+        message = PrebuiltMessage(render(records, argument))
+        with self._lock:
+            self._entries[cache_key] = (sheet_name, version, message)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return message
+
+    def get_marked(self, render, sheet_name, argument="", where=None):
+        # 斷路中且資料已過期時，在回覆後面附上提醒，讓使用者知道內容可能不是最新
+        message = self.get(render, sheet_name, argument, where)
+        if sheets_breaker.state == "closed" or worksheet_cache.is_fresh(self.spreadsheet_key, sheet_name):
+            return message
+        if len(message.messages) >= PUSH_MESSAGES_PER_CALL:
+            return message
+        minutes = int((worksheet_cache.age(self.spreadsheet_key, sheet_name) or 0) // 60)
+        return PrebuiltMessage(message.messages + [TextSendMessage(text=STALE_DATA_NOTICE.format(minutes=minutes))])
+
+    def invalidate_sheets(self, sheet_names):
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[0] in sheet_names]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+STALE_DATA_NOTICE = "⚠ 資料來源暫時無法連線，以上為約 {minutes} 分鐘前的資料，可能不是最新。"
+render_cache = RenderCache(MEMBER_SPREADSHEET_KEY, RENDER_CACHE_MAX_ENTRIES)
+
+@on_reference_change
+def drop_stale_renders(changed_sheets, changed_categories):
+    dropped = render_cache.invalidate_sheets(changed_sheets)
+    if dropped:
+        logger.info(f"🗂️ 已清除 {dropped} 份受影響的回覆快取")
+
+@on_reference_change
+def sync_read_model(changed_sheets, changed_categories):
+    if read_model is None:
+        return
+    for sheet_name in changed_sheets:
+        table = read_model.table_for("member", sheet_name)
+        if table:
+            read_model.replace(table, reference_snapshot.sheets[sheet_name])
+
+# 💬 回覆訊息：reply token 逾時或失效時改用 push_message
+def reply_messages(reply_token, messages):
+    if isinstance(messages, PrebuiltMessage):
+        line_bot_api._post("/v2/bot/message/reply", data=messages.body("replyToken", reply_token))
+    else:
+        line_bot_api.reply_message(reply_token, messages)
+
+def push_messages(user_id, messages):
+    push_dispatcher.send(user_id, messages)
+
+def send_reply(event, messages):
+    if time.time() * 1000 - event.timestamp > REPLY_TOKEN_TTL * 1000:
+        logger.info(f"reply token 已逾時，改用 push_message 回覆 {event.source.user_id}")
+        push_messages(event.source.user_id, messages)
+        return
+    try:
+        reply_messages(event.reply_token, messages)
+    except LineBotApiError as e:
+        if e.status_code == 400 and "reply token" in str(e.error.message).lower():
+            logger.info(f"reply token 已失效，改用 push_message 回覆 {event.source.user_id}")
+            push_messages(event.source.user_id, messages)
+        else:
+            raise
+
+# 📤 推播佇列：請求執行緒只負責排入，背景執行緒合併同一使用者的訊息、相同內容改用 multicast，
+# 依權杖桶控制呼叫頻率；429/5xx 以同一個 X-Line-Retry-Key 重送，LINE 端不會重複送出
+PushJob = namedtuple("PushJob", ["path", "recipients", "messages", "retry_key", "attempts"])
+
+class PushDispatcher:
+    def __init__(self, coalesce_window, push_rate, multicast_rate, max_attempts):
+        self.coalesce_window = coalesce_window
+        self.max_attempts = max_attempts
+        self._buckets = {
+            "/v2/bot/message/push": TokenBucket(push_rate),
+            "/v2/bot/message/multicast": TokenBucket(multicast_rate)
+        }
+        self._pending = OrderedDict()  # user_id -> 待送訊息（JSON dict），依排入順序
+        self._blocked = set()  # 還有訊息在重試中的使用者，後面的訊息要等它送出才能送，避免順序顛倒
+        self._retries = []  # (下次嘗試時間, PushJob)
+        self._cond = Condition()
+        self._started = False
+        self.stats_counter = {"queued": 0, "push_calls": 0, "multicast_calls": 0, "retries": 0, "dropped": 0}
+
+    def send(self, user_id, messages):
+        if isinstance(messages, PrebuiltMessage):
+            messages = messages.messages
+        elif not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        with self._cond:
+            self._pending.setdefault(user_id, []).extend(message.as_json_dict() for message in messages)
+            self.stats_counter["queued"] += len(messages)
+            self._cond.notify()
+        if not self._started:
+            self.start()
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        Thread(target=self._run, name="push-dispatcher", daemon=True).start()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self.stats_counter,
+                pending=sum(len(messages) for messages in self._pending.values()),
+                retrying=len(self._retries)
+            )
+
+    def _run(self):
+        while True:
+            try:
+                jobs = self._next_jobs()
+            except Exception as e:
+                logger.error(f"❌ 推播佇列處理失敗：{e}", exc_info=True)
+                time.sleep(1)
+                continue
+            for job in jobs:
+                self._deliver(job)  # 每個 job 自行處理錯誤，一個失敗不影響同批其他 job
+
+    def _next_jobs(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = [job for at, job in self._retries if at <= now]
+                ready = [user_id for user_id in self._pending if user_id not in self._blocked]
+                if due or ready:
+                    break
+                next_retry = min((at for at, _ in self._retries), default=None)
+                self._cond.wait(None if next_retry is None else next_retry - now)
+        if ready and not due:
+            time.sleep(self.coalesce_window)  # 稍等一下，讓同一批事件產生的訊息一起送
+        with self._cond:
+            now = time.monotonic()
+            due = [job for at, job in self._retries if at <= now]
+            self._retries = [(at, job) for at, job in self._retries if at > now]
+            groups = OrderedDict()  # 訊息內容 -> 收件者
+            for user_id in list(self._pending):
+                if user_id in self._blocked:
+                    continue
+                messages = self._pending[user_id]
+                chunk = messages[:PUSH_MESSAGES_PER_CALL]
+                del messages[:PUSH_MESSAGES_PER_CALL]
+                if not messages:
+                    del self._pending[user_id]
+                groups.setdefault(json.dumps(chunk, ensure_ascii=False, sort_keys=True), (chunk, []))[1].append(user_id)
+            jobs = list(due)
+            for chunk, recipients in groups.values():
+                if len(recipients) == 1:
+                    jobs.append(PushJob("/v2/bot/message/push", recipients, chunk, uuid.uuid4().hex, 0))
+                    continue
+                for i in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+                    jobs.append(PushJob(
+                        "/v2/bot/message/multicast", recipients[i:i + MULTICAST_MAX_RECIPIENTS], chunk, uuid.uuid4().hex, 0
+                    ))
+            for job in jobs:
+                self._blocked.update(job.recipients)
+        return jobs
+
+    def _deliver(self, job):
+        # 排入重試時收件者維持封鎖；其他任何結果（成功、被拒、非預期錯誤）都要解除，否則之後的訊息永遠送不出去
+        retrying = False
+        try:
+            if job.path == "/v2/bot/message/push":
+                body = {"to": job.recipients[0], "messages": job.messages}
+            else:
+                body = {"to": job.recipients, "messages": job.messages}
+            self._buckets[job.path].acquire()
+            line_bot_api._post(
+                job.path,
+                data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+                headers={"Content-Type": "application/json", "X-Line-Retry-Key": job.retry_key}
+            )
+            self.stats_counter["multicast_calls" if job.path.endswith("multicast") else "push_calls"] += 1
+        except LineBotApiError as e:
+            if e.status_code == 409:
+                pass  # 同一個 retry key 先前已被接受，視為成功
+            elif e.status_code == 429 or e.status_code >= 500:
+                retrying = self._retry(job, f"HTTP {e.status_code}")
+            else:
+                message = getattr(getattr(e, "error", None), "message", None) or str(e)
+                logger.error(f"❌ 推播被 LINE 拒絕（{e.status_code}），收件者 {len(job.recipients)} 位：{message}")
+                self.stats_counter["dropped"] += 1
+        except requests.RequestException as e:
+            retrying = self._retry(job, str(e))
+        except Exception as e:
+            logger.error(f"❌ 推播發生非預期錯誤，放棄這批訊息（收件者 {len(job.recipients)} 位）：{e}", exc_info=True)
+            self.stats_counter["dropped"] += 1
+        finally:
+            if not retrying:
+                with self._cond:
+                    self._blocked.difference_update(job.recipients)
+                    self._cond.notify()
+
+    def _retry(self, job, error):
+        # 回傳是否已排入重試；放棄時由 _deliver 解除收件者的封鎖
+        attempts = job.attempts + 1
+        with self._cond:
+            if attempts >= self.max_attempts:
+                logger.error(f"❌ 推播重試 {attempts} 次仍失敗，放棄：{error}")
+                self.stats_counter["dropped"] += 1
+                return False
+            delay = min(2 ** attempts, 60)
+            logger.warning(f"推播失敗（{error}），{delay} 秒後重試")
+            self.stats_counter["retries"] += 1
+            self._retries.append((time.monotonic() + delay, job._replace(attempts=attempts)))
+            self._cond.notify()
+        return True
+
+push_dispatcher = PushDispatcher(
+    PUSH_COALESCE_WINDOW,
+    PUSH_RATE_PER_SECOND,
+    MULTICAST_RATE_PER_SECOND,
+    PUSH_MAX_ATTEMPTS
+)
+
+# ⚙️ Webhook 事件處理：不同使用者的事件並行，同一使用者的事件依序處理
+# 以分段鎖保護 user_states，避免同一使用者的事件在不同請求中同時改動狀態機
+_user_locks = [Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def event_user_key(event):
+    return getattr(event.source, "user_id", None) or "__anonymous__"
+
+def user_lock(user_key):
+    return _user_locks[hash(user_key) % USER_LOCK_STRIPES]
+
+def dispatch_event(event):
+    try:
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            with user_lock(event_user_key(event)):
+                handle_message(event)
     except Exception as e:
-        logger.error(f"Google Sheets 授權錯誤：{e}", exc_info=True)
-        sys.exit(1)
+        logger.error(f"❌ 事件處理失敗：{e}", exc_info=True)
+
+class WebhookWorkerPool:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self._slots = BoundedSemaphore(queue_size)
+        self._executor = None
+        self._pending = {}  # 使用者 -> 等待處理的事件（已有事件在處理中）
+        self._lock = Lock()
+
+    def submit(self, event):
+        # 背景模式：每位使用者同時只佔一個工作執行緒，其餘事件排在該使用者的佇列後面
+        # 佇列滿時，已有事件在處理中的使用者仍排在自己的佇列後面（維持順序）；
+        # 沒有事件在處理中的使用者才改在請求中直接處理，處理期間後到的事件同樣排在後面
+        user_key = event_user_key(event)
+        with self._lock:
+            has_slot = self._slots.acquire(blocking=False)
+            pending = self._pending.get(user_key)
+            if pending is not None:
+                pending.append((event, has_slot))
+                return
+            self._pending[user_key] = deque()
+        if not has_slot:
+            logger.warning("事件佇列已滿，改在請求中直接處理")
+            self._drain(user_key, event, has_slot)
+            return
+        self._get_executor().submit(self._drain, user_key, event, has_slot)
+
+    def _drain(self, user_key, event, has_slot):
+        while True:
+            try:
+                dispatch_event(event)
+            finally:
+                if has_slot:
+                    self._slots.release()
+            with self._lock:
+                pending = self._pending[user_key]
+                if not pending:
+                    del self._pending[user_key]
+                    return
+                event, has_slot = pending.popleft()
+
+    def run_batch(self, events):
+        # 同步模式：依使用者分組並行處理，等待全部完成，延遲取決於最慢的那位使用者
+        groups = OrderedDict()
+        for event in events:
+            groups.setdefault(event_user_key(event), []).append(event)
+        if len(groups) <= 1:
+            for event in events:
+                dispatch_event(event)
+            return
+        futures = [self._get_executor().submit(self._run_group, group) for group in groups.values()]
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def _run_group(events):
+        for event in events:
+            dispatch_event(event)
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook-worker")
+        return self._executor
+
+webhook_pool = WebhookWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
 @app.route("/")
 def home():
     return "LINE Bot 正常運作中！"
 
+@app.route("/status")
+def status():
+    snapshot = reference_snapshot
+    return jsonify({
+        "reference_data": {
+            "loaded_at": snapshot.loaded_at.isoformat() if snapshot.loaded_at else None,
+            "duration_seconds": round(snapshot.duration, 3) if snapshot.duration is not None else None,
+            "sheets": {name: len(records) for name, records in snapshot.sheets.items()},
+            "categories": list(snapshot.booking_options["categories"].keys()),
+            "last_error": reference_refresh_error,
+            "source": reference_source
+        },
+        "booking_journal": booking_journal.stats(),
+        "sessions": user_states.stats(),
+        "render_cache": render_cache.stats(),
+        "course_calendar": course_calendar.stats(),
+        "read_model": read_model.stats() if read_model is not None else None,
+        "http_pools": http_pool_stats(),
+        "push_dispatcher": push_dispatcher.stats(),
+        "sheets_reads": sheets_reads.stats(),
+        "sheets_breaker": sheets_breaker.stats()
+    })
+
 @app.route("/webhook", methods=["POST"])
 def callback():
     signature = request.headers["X-Line-Signature"]
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
     try:
-        line_handler.handle(body, signature)
+        events = line_handler.parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+    if WEBHOOK_ASYNC:
+        for event in events:
+            webhook_pool.submit(event)
+    else:
+        webhook_pool.run_batch(events)
     return "OK"
 
+# 🧭 指令路由：完全相符查 dict、對話中的使用者依狀態分派、日期等格式用預先編譯的正規表示式
+class CommandRouter:
+    def __init__(self):
+        self.exact = {}
+        self.states = {}  # 狀態字串或 BookingFSM -> handler
+        self.patterns = []
+        self.default = None
+
+    def command(self, *texts):
+        def register(handler):
+            for text in texts:
+                self.exact[text] = handler
+            return handler
+        return register
+
+    def state(self, state):
+        def register(handler):
+            self.states[state] = handler
+            return handler
+        return register
+
+    def pattern(self, regex):
+        def register(handler):
+            self.patterns.append((re.compile(regex), handler))
+            return handler
+        return register
+
+    def fallback(self, handler):
+        self.default = handler
+        return handler
+
+    def resolve(self, user_id, user_msg):
+        handler = self.exact.get(user_msg)
+        if handler is not None:
+            return handler
+        state = user_states.get(user_id)
+        if state is not None:
+            handler = self.states.get(state if isinstance(state, str) else type(state))
+            if handler is not None:
+                return handler
+        for pattern, handler in self.patterns:
+            if pattern.match(user_msg):
+                return handler
+        return self.default
+
+command_router = CommandRouter()
+
 @line_handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_msg = event.message.text.strip()
     logger.info(f"使用者 {user_id} 傳送訊息：{user_msg}")
-    # 會員專區選單
-    if user_msg == "會員專區":
-        template = TemplateSendMessage(
-            alt_text="會員功能選單",
-            template=ButtonsTemplate(
-                title="會員專區",
-                text="請選擇功能",
-                actions=[
-                    MessageAction(label="查詢會員資料", text="查詢會員資料"),
-                ]
-            )
-        )
-        line_bot_api.reply_message(event.reply_token, template)
-
-    elif user_msg == "查詢會員資料":
-        user_states[user_id] = "awaiting_member_info"
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請輸入您的會員編號或姓名：")
+    if SESSION_EXPIRED_NOTICE and user_id not in user_states and user_states.pop_expired(user_id):
+        # 明確的指令照常執行；只有原本會交給逾時狀態處理的輸入才改回提醒，避免被當成一般訊息
+        if user_msg not in command_router.exact:
+            send_reply(event, TextSendMessage(text="⌛ 您先前的操作已閒置逾時，請重新開始。"))
+            return
+    handler = command_router.resolve(user_id, user_msg)
+    handler(event, user_id, user_msg)
+
+# 會員專區選單
+def build_member_menu():
+    template = TemplateSendMessage(
+        alt_text="會員功能選單",
+        template=ButtonsTemplate(
+            title="會員專區",
+            text="請選擇功能",
+            actions=[
+                MessageAction(label="查詢會員資料", text="查詢會員資料"),
+            ]
         )
-
-    elif user_states.get(user_id) == "awaiting_member_info":
-        user_states.pop(user_id)
-        keyword = user_msg.strip()
+    )
+    return template
+
+MEMBER_MENU = PrebuiltMessage(build_member_menu())
+
+@command_router.command("會員專區")
+def reply_member_menu(event, user_id, user_msg):
+    send_reply(event, MEMBER_MENU)
+
+@command_router.command("查詢會員資料")
+def start_member_query(event, user_id, user_msg):
+    user_states[user_id] = "awaiting_member_info"
+    send_reply(
+        event,
+        TextSendMessage(text="請輸入您的會員編號或姓名：")
+    )
+
+@command_router.state("awaiting_member_info")
+def reply_member_info(event, user_id, user_msg):
+    user_states.pop(user_id)
+    keyword = user_msg.strip()
     
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("會員資料")
-            records = sheet.get_all_records()
+    try:
+        index = get_member_index(MEMBER_SPREADSHEET_KEY)
     
-            # 判斷輸入是編號還是姓名
-            if re.match(r"^[A-Z]\d{5}$", keyword.upper()):  # 判斷是 A00001 類型
-                member_data = next(
-                    (row for row in records if str(row["會員編號"]).strip().upper() == keyword.upper()),
-                    None
-                )
-            else:
-                member_data = next(
-                    (row for row in records if keyword in row["姓名"]),
-                    None
-                )
-            if member_data:
-                reply_text = (
-                    f"✅ 查詢成功\n"
-                    f"👤 姓名：{member_data['姓名']}\n"
-                    f"📱 電話：{member_data['電話']}\n"
-                    f"🧾 會員類型：{member_data['會員類型']}\n"
-                    f"📌 狀態：{member_data['會員狀態']}\n"
-                    f"🎯 點數：{member_data['會員點數']}\n"
-                    f"⏳ 到期日：{member_data['會員到期日']}"
-                )
-                flex_message = FlexSendMessage(
-                    alt_text=f"{member_data['姓名']}的會員資料",
-                )
-            else:
-                reply_text = "❌ 查無此會員資料，請確認後再試一次。"
+        # 判斷輸入是編號還是姓名
+        if MEMBER_ID_PATTERN.match(keyword.upper()):  # 判斷是 A00001 類型
+            member_data = index.find_by_id(keyword)
+            matches = [member_data] if member_data else []
+        else:
+            matches = index.search_name(keyword)
+            member_data = pick_single_member(matches, keyword)
+        if len(matches) > 1 and not member_data:
+            user_states[user_id] = "awaiting_member_info"  # 讓使用者直接回覆會員編號
+            reply_text = format_member_choices(matches)
+        elif member_data:
+            reply_text = (
+                f"✅ 查詢成功\n"
+                f"👤 姓名：{member_data['姓名']}\n"
+                f"📱 電話：{member_data['電話']}\n"
+                f"🧾 會員類型：{member_data['會員類型']}\n"
+                f"📌 狀態：{member_data['會員狀態']}\n"
+                f"🎯 點數：{member_data['會員點數']}\n"
+                f"⏳ 到期日：{member_data['會員到期日']}"
+            )
+            flex_message = FlexSendMessage(
+                alt_text=f"{member_data['姓名']}的會員資料",
+            )
+        else:
+            reply_text = "❌ 查無此會員資料，請確認後再試一次。"
     
-        except Exception as e:
-            reply_text = f"❌ 查詢失敗：{str(e)}"
-            logger.error(f"會員查詢錯誤：{e}", exc_info=True)
+    except Exception as e:
+        reply_text = f"❌ 查詢失敗：{str(e)}"
+        logger.error(f"會員查詢錯誤：{e}", exc_info=True)
     
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-        
-    if user_msg == "常見問題":
-        faq_categories = ["準備運動", "會員方案", "課程", "其他"]
-        buttons = [
-            MessageAction(label=cat, text=cat)
-            for cat in faq_categories
-        ]
-        template = TemplateSendMessage(
-            alt_text="常見問題分類",
-            template=ButtonsTemplate(
-                title="常見問題",
-                text="請選擇分類",
-                actions=buttons[:4]  # ButtonsTemplate 最多只能放 4 個按鈕
-            )
+    send_reply(event, TextSendMessage(text=reply_text))
+
+def build_faq_menu():
+    faq_categories = ["準備運動", "會員方案", "課程", "其他"]
+    buttons = [
+        MessageAction(label=cat, text=cat)
+        for cat in faq_categories
+    ]
+    template = TemplateSendMessage(
+        alt_text="常見問題分類",
+        template=ButtonsTemplate(
+            title="常見問題",
+            text="請選擇分類",
+            actions=buttons[:4]  # ButtonsTemplate 最多只能放 4 個按鈕
         )
-        line_bot_api.reply_message(event.reply_token, template)
-
-    elif user_msg in ["課程"]:
-        confirm_template = TemplateSendMessage(
-            alt_text = 'confirm template',
-            template = ConfirmTemplate(
-                text = '🧾',
-                actions = [
-                    MessageAction(
-                        label = '個人教練',
-                        text = '個人教練課程'),
-                    MessageAction(
-                        label = '團體',
-                        text = '團體課程')]
-                )
+    )
+    return template
+
+FAQ_MENU = PrebuiltMessage(build_faq_menu())
+
+@command_router.command("常見問題")
+def reply_faq_menu(event, user_id, user_msg):
+    send_reply(event, FAQ_MENU)
+
+def build_course_menu():
+    confirm_template = TemplateSendMessage(
+        alt_text = 'confirm template',
+        template = ConfirmTemplate(
+            text = '🧾',
+            actions = [
+                MessageAction(
+                    label = '個人教練',
+                    text = '個人教練課程'),
+                MessageAction(
+                    label = '團體',
+                    text = '團體課程')]
             )
-        line_bot_api.reply_message(event.reply_token, confirm_template)
+        )
+    return confirm_template
 
-    elif user_msg in ["準備運動", "會員方案", "個人教練課程", "團體課程", "其他"]:
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("常見問題")
-            records = sheet.get_all_records()
-            matched = [row for row in records if row["分類"] == user_msg]
+COURSE_MENU = PrebuiltMessage(build_course_menu())
 
-            if not matched:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="找不到相關問題。"))
-                return
+@command_router.command("課程")
+def reply_course_menu(event, user_id, user_msg):
+    send_reply(event, COURSE_MENU)
+
+def render_faq_answers(records, category):
+    matched = [row for row in records if row["分類"] == category]
+
+    if not matched:
+        return TextSendMessage(text="找不到相關問題。")
+
+    bubbles = []
+    for item in matched:
+        bubble = {
+            "type": "bubble",
+            "size": "mega",
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": f"❓ {item['問題']}",
+                        "wrap": True,
+                        "weight": "bold",
+                        "size": "md",
+                        "color": "#333333"
+                    },
+                    {
+                        "type": "text",
+                        "text": f"💡 {item['答覆']}",
+                        "wrap": True,
+                        "size": "sm",
+                        "color": "#666666"
+                    }
+                ]
+            }
+        }
+        bubbles.append(bubble)
+
+    flex_message = FlexSendMessage(
+        alt_text=f"{category} 的常見問題",
+        contents={
+            "type": "carousel",
+            "contents": bubbles[:10]  # 最多 10 筆
+        }
+    )
+    return flex_message
 
-            bubbles = []
-            for item in matched:
-                bubble = {
+@command_router.command("準備運動", "會員方案", "個人教練課程", "團體課程", "其他")
+def reply_faq_answers(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_faq_answers, "常見問題", user_msg, where={"分類": user_msg}))
+    except Exception as e:
+        logger.error(f"常見問題查詢錯誤：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text="⚠ 查詢失敗，請稍後再試。"))
+
+def build_more_features_menu():
+    flex_message = FlexSendMessage(
+        alt_text="更多功能選單",
+        contents={
+            "type": "carousel",
+            "contents": [
+                {
                     "type": "bubble",
-                    "size": "mega",
+                    "hero": {
+                        "type": "image",
+                        "url": "https://i.imgur.com/d3v7RxR.png",  # 替換為場地圖片
+                        "size": "full",
+                        "aspectRatio": "20:13",
+                        "aspectMode": "cover"
+                    },
                     "body": {
                         "type": "box",
                         "layout": "vertical",
-                        "spacing": "sm",
                         "contents": [
                             {
                                 "type": "text",
-                                "text": f"❓ {item['問題']}",
-                                "wrap": True,
+                                "text": "🏟️ 場地介紹",
                                 "weight": "bold",
-                                "size": "md",
-                                "color": "#333333"
+                                "size": "xl"
                             },
                             {
                                 "type": "text",
-                                "text": f"💡 {item['答覆']}",
-                                "wrap": True,
+                                "text": "探索我們的健身空間",
                                 "size": "sm",
+                                "wrap": True,
                                 "color": "#666666"
                             }
                         ]
-                    }
-                }
-                bubbles.append(bubble)
-
-            flex_message = FlexSendMessage(
-                alt_text=f"{user_msg} 的常見問題",
-                contents={
-                    "type": "carousel",
-                    "contents": bubbles[:10]  # 最多 10 筆
-                }
-            )
-            line_bot_api.reply_message(event.reply_token, flex_message)
-
-        except Exception as e:
-            logger.error(f"常見問題查詢錯誤：{e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠ 查詢失敗，請稍後再試。"))
-            
-    elif user_msg == "更多功能":
-        flex_message = FlexSendMessage(
-            alt_text="更多功能選單",
-            contents={
-                "type": "carousel",
-                "contents": [
-                    {
-                        "type": "bubble",
-                        "hero": {
-                            "type": "image",
-                            "url": "https://i.imgur.com/d3v7RxR.png",  # 替換為場地圖片
-                            "size": "full",
-                            "aspectRatio": "20:13",
-                            "aspectMode": "cover"
-                        },
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": "🏟️ 場地介紹",
-                                    "weight": "bold",
-                                    "size": "xl"
+                    },
+                    "footer": {
+                        "type": "box",
+                        "layout": "horizontal",
+                        "spacing": "sm",
+                        "contents": [
+                            {
+                                "type": "button",
+                                "action": {
+                                    "type": "message",
+                                    "label": "健身/重訓",
+                                    "text": "健身/重訓"
                                 },
-                                {
-                                    "type": "text",
-                                    "text": "探索我們的健身空間",
-                                    "size": "sm",
-                                    "wrap": True,
-                                    "color": "#666666"
+                                "style": "primary"
+                            },
+                            {
+                                "type": "button",
+                                "action": {
+                                    "type": "message",
+                                    "label": "上課教室",
+                                    "text": "上課教室"
                                 }
-                            ]
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "horizontal",
-                            "spacing": "sm",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "健身/重訓",
-                                        "text": "健身/重訓"
-                                    },
-                                    "style": "primary"
+                            }
+                        ]
+                    }
+                },
+                {
+                    "type": "bubble",
+                    "hero": {
+                        "type": "image",
+                        "url": "https://i.imgur.com/HrtfSdH.png",  # 替換為課程圖片
+                        "size": "full",
+                        "aspectRatio": "20:13",
+                        "aspectMode": "cover"
+                    },
+                    "body": {
+                        "type": "box",
+                        "layout": "vertical",
+                        "contents": [
+                            {
+                                "type": "text",
+                                "text": "📚 課程介紹",
+                                "weight": "bold",
+                                "size": "xl"
+                            },
+                            {
+                                "type": "text",
+                                "text": "了解我們提供的課程類型",
+                                "size": "sm",
+                                "wrap": True,
+                                "color": "#666666"
+                            }
+                        ]
+                    },
+                    "footer": {
+                        "type": "box",
+                        "layout": "vertical",
+                        "contents": [
+                            {
+                                "type": "button",
+                                "action": {
+                                    "type": "message",
+                                    "label": "查看課程內容",
+                                    "text": "課程內容"
                                 },
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "上課教室",
-                                        "text": "上課教室"
-                                    }
-                                }
-                            ]
-                        }
+                                "style": "primary"
+                            }
+                        ]
+                    }
+                },
+                {
+                    "type": "bubble",
+                    "hero": {
+                        "type": "image",
+                        "url": "https://i.imgur.com/izThqNv.png",  # 替換為團隊圖片
+                        "size": "full",
+                        "aspectRatio": "20:13",
+                        "aspectMode": "cover"
                     },
-                    {
-                        "type": "bubble",
-                        "hero": {
-                            "type": "image",
-                            "url": "https://i.imgur.com/HrtfSdH.png",  # 替換為課程圖片
-                            "size": "full",
-                            "aspectRatio": "20:13",
-                            "aspectMode": "cover"
-                        },
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": "📚 課程介紹",
-                                    "weight": "bold",
-                                    "size": "xl"
+                    "body": {
+                        "type": "box",
+                        "layout": "vertical",
+                        "contents": [
+                            {
+                                "type": "text",
+                                "text": "👥 團隊介紹",
+                                "weight": "bold",
+                                "size": "xl"
+                            },
+                            {
+                                "type": "text",
+                                "text": "認識我們的教練與團隊",
+                                "size": "sm",
+                                "wrap": True,
+                                "color": "#666666"
+                            }
+                        ]
+                    },
+                    "footer": {
+                        "type": "box",
+                        "layout": "horizontal",
+                        "spacing": "sm",
+                        "contents": [
+                            {
+                                "type": "button",
+                                "action": {
+                                    "type": "message",
+                                    "label": "健身教練",
+                                    "text": "健身教練"
                                 },
-                                {
-                                    "type": "text",
-                                    "text": "了解我們提供的課程類型",
-                                    "size": "sm",
-                                    "wrap": True,
-                                    "color": "#666666"
-                                }
-                            ]
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "查看課程內容",
-                                        "text": "課程內容"
-                                    },
-                                    "style": "primary"
+                                "style": "primary"
+                            },
+                            {
+                                "type": "button",
+                                "action": {
+                                    "type": "message",
+                                    "label": "課程老師",
+                                    "text": "課程老師"
                                 }
-                            ]
-                        }
+                            }
+                        ]
+                    }
+                }
+            ]
+        }
+    )
+    return flex_message
+
+MORE_FEATURES_MENU = PrebuiltMessage(build_more_features_menu())
+
+@command_router.command("更多功能")
+def reply_more_features(event, user_id, user_msg):
+    send_reply(event, MORE_FEATURES_MENU)
+
+def render_classrooms(records, _argument):
+    matched = [
+        row for row in records
+        if row.get("類型", "").strip() == "上課教室" and row.get("圖片1", "").startswith("https")
+    ]
+
+    if not matched:
+        return TextSendMessage(text="⚠ 查無『上課教室』的場地資料")
+
+    image_columns = [
+        ImageCarouselColumn(
+            image_url=row["圖片1"],
+            action=MessageAction(label=row.get("名稱", "查看詳情"), text=row.get("名稱", "查看詳情"))
+        ) for row in matched
+    ]
+
+    carousel = TemplateSendMessage(
+        alt_text="上課教室場地列表",
+        template=ImageCarouselTemplate(columns=image_columns[:10])
+    )
+    return carousel
+
+@command_router.command("上課教室")
+def reply_classrooms(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_classrooms, "場地資料", where={"類型": "上課教室"}))
+    except Exception as e:
+        logger.error(f"上課教室查詢失敗：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
+
+def build_equipment_menu():
+    # 顯示分類選單（按鈕）
+    subcategories = ["心肺訓練", "背部訓練", "腿部訓練", "自由重量器材"]
+    buttons = [
+        MessageAction(label=sub, text=sub)
+        for sub in subcategories[:4]  # 先顯示前4個
+    ]
+    # 第二個 bubble 可加更多分類
+    template = TemplateSendMessage(
+        alt_text="健身/重訓 器材分類",
+        template=ButtonsTemplate(
+            title="健身/重訓 器材分類",
+            text="請選擇器材分類",
+            actions=buttons
+        )
+    )
+    return template
+
+EQUIPMENT_MENU = PrebuiltMessage(build_equipment_menu())
+
+@command_router.command("健身/重訓")
+def reply_equipment_menu(event, user_id, user_msg):
+    send_reply(event, EQUIPMENT_MENU)
+
+def render_equipment(records, category):
+    matched = [
+        row for row in records
+        if row.get("分類", "").strip() == category and row.get("圖片1", "").startswith("https")
+    ]
+
+    if not matched:
+        return TextSendMessage(text=f"⚠ 查無『{category}』分類的器材圖片")
+
+    # 每 10 筆一組，合併成同一次回覆（一次最多 5 則訊息）
+    carousels = []
+    for i in range(0, min(len(matched), 50), 10):
+        chunk = matched[i:i + 10]
+        image_columns = [
+            ImageCarouselColumn(
+                image_url=row["圖片1"],
+                action=MessageAction(label=row.get("名稱", "查看詳情"), text=row.get("名稱", "查看詳情"))
+            ) for row in chunk
+        ]
+
+        carousel = TemplateSendMessage(
+            alt_text=f"{category} 器材圖片",
+            template=ImageCarouselTemplate(columns=image_columns)
+        )
+        carousels.append(carousel)
+    return carousels
+
+@command_router.command("心肺訓練", "背部訓練", "腿部訓練", "自由重量器材")
+def reply_equipment(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_equipment, "場地資料", user_msg, where={"分類": user_msg}))
+    except Exception as e:
+        logger.error(f"{user_msg} 分類查詢錯誤：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text="⚠ 發生錯誤，請稍後再試。"))
+
+def render_fitness_coaches(records, _argument):
+    matched = [
+        row for row in records
+        if row.get("教練類型", "").strip() == "健身教練" and row.get("圖片", "").startswith("https")
+    ]
+
+    if not matched:
+        return TextSendMessage(text="⚠ 查無『健身教練』的資料")
+
+    bubbles = []
+    for row in matched:
+        bubble = {
+            "type": "bubble",
+            "hero": {
+                "type": "image",
+                "url": row["圖片"],
+                "size": "full",
+                "aspectRatio": "20:13",
+                "aspectMode": "cover"
+            },
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": f"{row['姓名']}（{row['教練類別']}）",
+                        "weight": "bold",
+                        "size": "lg",
+                        "wrap": True
                     },
                     {
-                        "type": "bubble",
-                        "hero": {
-                            "type": "image",
-                            "url": "https://i.imgur.com/izThqNv.png",  # 替換為團隊圖片
-                            "size": "full",
-                            "aspectRatio": "20:13",
-                            "aspectMode": "cover"
-                        },
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": "👥 團隊介紹",
-                                    "weight": "bold",
-                                    "size": "xl"
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "認識我們的教練與團隊",
-                                    "size": "sm",
-                                    "wrap": True,
-                                    "color": "#666666"
-                                }
-                            ]
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "horizontal",
-                            "spacing": "sm",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "健身教練",
-                                        "text": "健身教練"
-                                    },
-                                    "style": "primary"
-                                },
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "課程老師",
-                                        "text": "課程老師"
-                                    }
-                                }
-                            ]
+                        "type": "text",
+                        "text": f"專長：{row.get('專長', '未提供')}",
+                        "size": "sm",
+                        "wrap": True,
+                        "color": "#666666"
+                    }
+                ]
+            },
+            "footer": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "button",
+                        "style": "primary",
+                        "action": {
+                            "type": "message",
+                            "label": "立即預約",
+                            "text": f"我要預約 {row['姓名']}"
                         }
                     }
                 ]
             }
-        )
-        line_bot_api.reply_message(event.reply_token, flex_message)
-
-    elif user_msg == "上課教室":
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("場地資料")
-            records = sheet.get_all_records()
-
-            matched = [
-                row for row in records
-                if row.get("類型", "").strip() == "上課教室" and row.get("圖片1", "").startswith("https")
-            ]
-
-            if not matched:
-                line_bot_api.reply_message(
-                    event.reply_token, TextSendMessage(text="⚠ 查無『上課教室』的場地資料")
-                )
-                return
-
-            image_columns = [
-                ImageCarouselColumn(
-                    image_url=row["圖片1"],
-                    action=MessageAction(label=row.get("名稱", "查看詳情"), text=row.get("名稱", "查看詳情"))
-                ) for row in matched
-            ]
+        }
+        bubbles.append(bubble)
 
-            carousel = TemplateSendMessage(
-                alt_text="上課教室場地列表",
-                template=ImageCarouselTemplate(columns=image_columns[:10])
-            )
-            line_bot_api.reply_message(event.reply_token, carousel)
+    flex_message = FlexSendMessage(
+        alt_text="健身教練清單",
+        contents={
+            "type": "carousel",
+            "contents": bubbles[:10]
+        }
+    )
+    return flex_message
 
-        except Exception as e:
-            logger.error(f"上課教室查詢失敗：{e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
-            
-    elif user_msg == "健身/重訓":
-        # 顯示分類選單（按鈕）
-        subcategories = ["心肺訓練", "背部訓練", "腿部訓練", "自由重量器材"]
-        buttons = [
-            MessageAction(label=sub, text=sub)
-            for sub in subcategories[:4]  # 先顯示前4個
-        ]
-        # 第二個 bubble 可加更多分類
-        template = TemplateSendMessage(
-            alt_text="健身/重訓 器材分類",
-            template=ButtonsTemplate(
-                title="健身/重訓 器材分類",
-                text="請選擇器材分類",
-                actions=buttons
-            )
+@command_router.command("健身教練")
+def reply_fitness_coaches(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_fitness_coaches, "教練資料", where={"教練類型": "健身教練"}))
+    except Exception as e:
+        logger.error(f"健身教練查詢失敗：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
+
+def build_course_coach_menu():
+    # 顯示分類選單（按鈕）
+    subcategories = ["有氧教練", "瑜珈老師", "游泳教練"]
+    buttons = [
+        MessageAction(label=sub, text=sub)
+        for sub in subcategories[:4]  # 先顯示前4個
+    ]
+    # 第二個 bubble 可加更多分類
+    template = TemplateSendMessage(
+        alt_text="課程教練分類",
+        template=ButtonsTemplate(
+            title="課程教練分類",
+            text="請選擇課程教練",
+            actions=buttons
         )
-        line_bot_api.reply_message(event.reply_token, template)
-        
-    elif user_msg in ["心肺訓練", "背部訓練", "腿部訓練", "自由重量器材"]:
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("場地資料")
-            records = sheet.get_all_records()
-
-            matched = [
-                row for row in records
-                if row.get("分類", "").strip() == user_msg and row.get("圖片1", "").startswith("https")
-            ]
-
-            if not matched:
-                line_bot_api.reply_message(
-                    event.reply_token, TextSendMessage(text=f"⚠ 查無『{user_msg}』分類的器材圖片")
-                )
-                
-                return
-
-            # 每 10 筆一組發送
-            for i in range(0, len(matched), 10):
-                chunk = matched[i:i + 10]
-                image_columns = [
-                    ImageCarouselColumn(
-                        image_url=row["圖片1"],
-                        action=MessageAction(label=row.get("名稱", "查看詳情"), text=row.get("名稱", "查看詳情"))
-                    ) for row in chunk
+    )
+    return template
+
+COURSE_COACH_MENU = PrebuiltMessage(build_course_coach_menu())
+
+@command_router.command("課程教練")
+def reply_course_coach_menu(event, user_id, user_msg):
+    send_reply(event, COURSE_COACH_MENU)
+
+def render_course_coaches(records, coach_type):
+    matched = [
+        row for row in records
+        if row.get("教練類別", "").strip() == coach_type and row.get("圖片", "").startswith("https")
+    ]
+
+    if not matched:
+        return TextSendMessage(text=f"⚠ 查無『{coach_type}』的資料")
+
+    bubbles = []
+    for row in matched:
+        bubble = {
+            "type": "bubble",
+            "hero": {
+                "type": "image",
+                "url": row["圖片"],
+                "size": "full",
+                "aspectRatio": "20:13",
+                "aspectMode": "cover"
+            },
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": f"{row['姓名']}（{row['教練類別']}）",
+                        "weight": "bold",
+                        "size": "lg",
+                        "wrap": True
+                    },
+                    {
+                        "type": "text",
+                        "text": f"專長：{row.get('專長', '未提供')}",
+                        "size": "sm",
+                        "wrap": True,
+                        "color": "#666666"
+                    }
                 ]
+            },
+            "footer": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "button",
+                        "style": "primary",
+                        "action": {
+                            "type": "message",
+                            "label": "立即預約",
+                            "text": f"我要預約 {row['姓名']}"
+                        }
+                    }
+                ]
+            }
+        }
+        bubbles.append(bubble)
 
-                carousel = TemplateSendMessage(
-                    alt_text=f"{user_msg} 器材圖片",
-                    template=ImageCarouselTemplate(columns=image_columns)
-                )
-                line_bot_api.reply_message(event.reply_token, carousel)
-
-        except Exception as e:
-            logger.error(f"{user_msg} 分類查詢錯誤：{e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠ 發生錯誤，請稍後再試。"))
-    elif user_msg == "上課教室":
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("場地資料")
-            records = sheet.get_all_records()
+    flex_message = FlexSendMessage(
+        alt_text="課程教練清單",
+        contents={
+            "type": "carousel",
+            "contents": bubbles[:10]
+        }
+    )
+    return flex_message
 
-            matched = [
-                row for row in records
-                if row.get("類型", "").strip() == "上課教室" and row.get("圖片1", "").startswith("https")
+@command_router.command("有氧教練", "瑜珈老師", "游泳教練")
+def reply_course_coaches(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_course_coaches, "教練資料", user_msg, where={"教練類別": user_msg}))
+    except Exception as e:
+        logger.error(f"課程教練查詢失敗：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
+
+def render_course_types(records, _argument):
+    # 提取唯一課程類型
+    course_types = list({row["課程類型"].strip() for row in records if row.get("課程類型")})
+    course_types = [t for t in course_types if t]
+
+    # 建立按鈕
+    buttons = [
+        {
+            "type": "button",
+            "style": "secondary",
+            "action": {
+                "type": "message",
+                "label": t,
+                "text": t
+            }
+        } for t in course_types[:6]
+    ]
+
+    bubble = {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "📚 課程內容查詢",
+                    "weight": "bold",
+                    "size": "lg",
+                    "margin": "md"
+                },
+                {
+                    "type": "box",
+                    "layout": "vertical",
+                    "spacing": "sm",
+                    "margin": "lg",
+                    "contents": buttons
+                }
             ]
+        }
+    }
 
-            if not matched:
-                line_bot_api.reply_message(
-                    event.reply_token, TextSendMessage(text="⚠ 查無『上課教室』的場地資料")
-                )
-                return
-
-            image_columns = [
-                ImageCarouselColumn(
-                    image_url=row["圖片1"],
-                    action=MessageAction(label=row.get("名稱", "查看詳情"), text=row.get("名稱", "查看詳情"))
-                ) for row in matched
-            ]
+    flex_msg = FlexSendMessage(
+        alt_text="課程類型查詢",
+        contents=bubble
+    )
 
-            carousel = TemplateSendMessage(
-                alt_text="上課教室場地列表",
-                template=ImageCarouselTemplate(columns=image_columns[:10])
-            )
-            line_bot_api.reply_message(event.reply_token, carousel)
+    return [
+        flex_msg,
+        TextSendMessage(text="📅 你也可以輸入日期（例如：2025-05-01）查詢當天有上課的課程，或輸入「本週課程」查看這週的課表。")
+    ]
 
-        except Exception as e:
-            logger.error(f"上課教室查詢失敗：{e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
-            
-    elif user_msg == "健身教練":
-         try:
-             client = get_gspread_client()
-             sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("教練資料")
-             records = sheet.get_all_records()
- 
-             matched = [
-                 row for row in records
-                 if row.get("教練類型", "").strip() == "健身教練" and row.get("圖片", "").startswith("https")
-             ]
- 
-             if not matched:
-                 line_bot_api.reply_message(
-                     event.reply_token, TextSendMessage(text="⚠ 查無『健身教練』的資料")
-                 )
-                 return
- 
-             bubbles = []
-             for row in matched:
-                 bubble = {
-                     "type": "bubble",
-                     "hero": {
-                         "type": "image",
-                         "url": row["圖片"],
-                         "size": "full",
-                         "aspectRatio": "20:13",
-                         "aspectMode": "cover"
-                     },
-                     "body": {
-                         "type": "box",
-                         "layout": "vertical",
-                         "spacing": "sm",
-                         "contents": [
-                             {
-                                 "type": "text",
-                                 "text": f"{row['姓名']}（{row['教練類別']}）",
-                                 "weight": "bold",
-                                 "size": "lg",
-                                 "wrap": True
-                             },
-                             {
-                                 "type": "text",
-                                 "text": f"專長：{row.get('專長', '未提供')}",
-                                 "size": "sm",
-                                 "wrap": True,
-                                 "color": "#666666"
-                             }
-                         ]
-                     },
-                     "footer": {
-                         "type": "box",
-                         "layout": "vertical",
-                         "spacing": "sm",
-                         "contents": [
-                             {
-                                 "type": "button",
-                                 "style": "primary",
-                                 "action": {
-                                     "type": "message",
-                                     "label": "立即預約",
-                                     "text": f"我要預約 {row['姓名']}"
-                                 }
-                             }
-                         ]
-                     }
-                 }
-                 bubbles.append(bubble)
- 
-             flex_message = FlexSendMessage(
-                 alt_text="健身教練清單",
-                 contents={
-                     "type": "carousel",
-                     "contents": bubbles[:10]
-                 }
-             )
-             line_bot_api.reply_message(event.reply_token, flex_message)
- 
-         except Exception as e:
-             logger.error(f"健身教練查詢失敗：{e}", exc_info=True)
-             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
-
-    elif user_msg == "課程教練":
-        # 顯示分類選單（按鈕）
-        subcategories = ["有氧教練", "瑜珈老師", "游泳教練"]
-        buttons = [
-            MessageAction(label=sub, text=sub)
-            for sub in subcategories[:4]  # 先顯示前4個
-        ]
-        # 第二個 bubble 可加更多分類
-        template = TemplateSendMessage(
-            alt_text="課程教練分類",
-            template=ButtonsTemplate(
-                title="課程教練分類",
-                text="請選擇課程教練",
-                actions=buttons
-            )
-        )
-        line_bot_api.reply_message(event.reply_token, template)
-        
-    elif user_msg in ["有氧教練", "瑜珈老師", "游泳教練"]:
-         try:
-             client = get_gspread_client()
-             sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("教練資料")
-             records = sheet.get_all_records()
- 
-             matched = [
-                 row for row in records
-                 if row.get("教練類別", "").strip() == user_msg and row.get("圖片", "").startswith("https")
-             ]
- 
-             if not matched:
-                 line_bot_api.reply_message(
-                     event.reply_token, TextSendMessage(text="⚠ 查無『{user_msg}』的資料")
-                 )
-                 return
- 
-             bubbles = []
-             for row in matched:
-                 bubble = {
-                     "type": "bubble",
-                     "hero": {
-                         "type": "image",
-                         "url": row["圖片"],
-                         "size": "full",
-                         "aspectRatio": "20:13",
-                         "aspectMode": "cover"
-                     },
-                     "body": {
-                         "type": "box",
-                         "layout": "vertical",
-                         "spacing": "sm",
-                         "contents": [
-                             {
-                                 "type": "text",
-                                 "text": f"{row['姓名']}（{row['教練類別']}）",
-                                 "weight": "bold",
-                                 "size": "lg",
-                                 "wrap": True
-                             },
-                             {
-                                 "type": "text",
-                                 "text": f"專長：{row.get('專長', '未提供')}",
-                                 "size": "sm",
-                                 "wrap": True,
-                                 "color": "#666666"
-                             }
-                         ]
-                     },
-                     "footer": {
-                         "type": "box",
-                         "layout": "vertical",
-                         "spacing": "sm",
-                         "contents": [
-                             {
-                                 "type": "button",
-                                 "style": "primary",
-                                 "action": {
-                                     "type": "message",
-                                     "label": "立即預約",
-                                     "text": f"我要預約 {row['姓名']}"
-                                 }
-                             }
-                         ]
-                     }
-                 }
-                 bubbles.append(bubble)
- 
-             flex_message = FlexSendMessage(
-                 alt_text="課程教練清單",
-                 contents={
-                     "type": "carousel",
-                     "contents": bubbles[:10]
-                 }
-             )
-             line_bot_api.reply_message(event.reply_token, flex_message)
- 
-         except Exception as e:
-             logger.error(f"課程教練查詢失敗：{e}", exc_info=True)
-             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
-            
-    elif user_msg == "課程內容":
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("課程資料")
-            records = sheet.get_all_records()
+@command_router.command("課程內容")
+def reply_course_types(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_course_types, "課程資料"))
+    except Exception as e:
+        logger.error(f"課程內容查詢錯誤：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text="⚠ 無法讀取課程資料"))
+
+def render_courses_by_type(records, course_type):
+    matched = [row for row in records if row.get("課程類型", "").strip() == course_type]
+
+    if not matched:
+        return TextSendMessage(text=f"❌ 查無『{course_type}』相關課程")
+
+    bubbles = []
+    for row in matched[:10]:
+        bubbles.append({
+            "type": "bubble",
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {"type": "text", "text": row.get("課程名稱", "（未提供課程名稱）"), "weight": "bold", "size": "lg", "wrap": True},
+                    {"type": "text", "text": f"👨‍🏫 教練：{row.get('教練姓名', '未知')}", "size": "sm", "wrap": True},
+                    {"type": "text", "text": f"📅 開課日期：{row.get('開始日期', '未提供')}", "size": "sm"},
+                    {"type": "text", "text": f"🕒 上課時間：{row.get('上課時間', '未提供')}", "size": "sm"},
+                    {"type": "text", "text": f"⏱️ 時間：{row.get('時間', '未提供')}", "size": "sm"},
+                    {"type": "text", "text": f"💲 價格：{row.get('課程價格', '未定')}", "size": "sm"}
+                ]
+            }
+        })
 
-            # 提取唯一課程類型
-            course_types = list({row["課程類型"].strip() for row in records if row.get("課程類型")})
-            course_types = [t for t in course_types if t]
+    return FlexSendMessage(
+        alt_text=f"{course_type} 課程內容",
+        contents={"type": "carousel", "contents": bubbles}
+    )
 
-            # 建立按鈕
-            buttons = [
-                {
-                    "type": "button",
-                    "style": "secondary",
-                    "action": {
-                        "type": "message",
-                        "label": t,
-                        "text": t
-                    }
-                } for t in course_types[:6]
-            ]
+@command_router.command("有氧課程", "瑜珈課程", "游泳課程")
+def reply_courses_by_type(event, user_id, user_msg):
+    try:
+        send_reply(event, render_cache.get_marked(render_courses_by_type, "課程資料", user_msg, where={"課程類型": user_msg}))
+    except Exception as e:
+        logger.error(f"課程類型查詢錯誤：{e}", exc_info=True)
+        send_reply(
+            event,
+            TextSendMessage(text=f"⚠ 無法查詢課程內容（錯誤：{str(e)}）")
+        )
 
-            bubble = {
+@command_router.pattern(r"^\d{4}[-/]\d{2}[-/]\d{2}$")
+def reply_courses_by_date(event, user_id, user_msg):
+    query_date = user_msg.replace("/", "-").strip()
+    day = parse_course_date(query_date)
+    if day is None:
+        send_reply(event, TextSendMessage(text="❌ 日期不正確，請輸入有效的日期（例如：2025-05-01）"))
+        return
+    try:
+        # 依開始/結束日期與每週上課日判斷，不只比對開課當天
+        matched = get_course_calendar().on_date(day)
+    
+        if not matched:
+            send_reply(event, TextSendMessage(text="❌ 該日期無任何課程"))
+            return
+    
+        bubbles = []
+        for row in matched[:10]:
+            bubbles.append({
                 "type": "bubble",
                 "body": {
                     "type": "box",
                     "layout": "vertical",
+                    "spacing": "sm",
                     "contents": [
-                        {
-                            "type": "text",
-                            "text": "📚 課程內容查詢",
-                            "weight": "bold",
-                            "size": "lg",
-                            "margin": "md"
-                        },
-                        {
-                            "type": "box",
-                            "layout": "vertical",
-                            "spacing": "sm",
-                            "margin": "lg",
-                            "contents": buttons
-                        }
+                        {"type": "text", "text": row.get("課程名稱", "（未提供課程名稱）"), "weight": "bold", "size": "lg", "wrap": True},
+                        {"type": "text", "text": f"👨‍🏫 教練：{row.get('教練姓名', '未知')}", "size": "sm", "wrap": True},
+                        {"type": "text", "text": f"📅 開課日期：{row.get('開始日期', '未提供')}", "size": "sm"},
+                        {"type": "text", "text": f"🕒 上課時間：{row.get('上課時間', '未提供')}", "size": "sm"},
+                        {"type": "text", "text": f"⏱️ 時間：{row.get('時間', '未提供')}", "size": "sm"},
+                        {"type": "text", "text": f"💲 價格：{row.get('課程價格', '未定')}", "size": "sm"}
                     ]
                 }
-            }
-
-            flex_msg = FlexSendMessage(
-                alt_text="課程類型查詢",
-                contents=bubble
-            )
-
-            line_bot_api.reply_message(
-                event.reply_token,
-                [
-                    flex_msg,
-                    TextSendMessage(text="📅 你也可以輸入日期（例如：2025-05-01）查詢當天開課課程。")
-                ]
+            })
+    
+        send_reply(
+            event,
+            FlexSendMessage(
+                alt_text=f"{query_date} 的課程",
+                contents={"type": "carousel", "contents": bubbles}
             )
+        )
+    
+    except Exception as e:
+        logger.error(f"課程日期查詢錯誤：{e}", exc_info=True)
+        send_reply(
+            event,
+            TextSendMessage(text=f"⚠ 無法查詢課程內容（錯誤訊息：{str(e)}）")
+        )
 
-        except Exception as e:
-            logger.error(f"課程內容查詢錯誤：{e}", exc_info=True)
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠ 無法讀取課程資料"))
-
-    elif user_msg in ["有氧課程", "瑜珈課程", "游泳課程"]:
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("課程資料")
-            records = sheet.get_all_records()
-
-            matched = [row for row in records if row.get("課程類型", "").strip() == user_msg]
-
-            if not matched:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 查無『{user_msg}』相關課程"))
-                return
-
-            bubbles = []
-            for row in matched[:10]:
-                bubbles.append({
-                    "type": "bubble",
-                    "body": {
-                        "type": "box",
-                        "layout": "vertical",
-                        "spacing": "sm",
-                        "contents": [
-                            {"type": "text", "text": row.get("課程名稱", "（未提供課程名稱）"), "weight": "bold", "size": "lg", "wrap": True},
-                            {"type": "text", "text": f"👨‍🏫 教練：{row.get('教練姓名', '未知')}", "size": "sm", "wrap": True},
-                            {"type": "text", "text": f"📅 開課日期：{row.get('開始日期', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"🕒 上課時間：{row.get('上課時間', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"⏱️ 時間：{row.get('時間', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"💲 價格：{row.get('課程價格', '未定')}", "size": "sm"}
-                        ]
-                    }
+@command_router.command("本週課程")
+def reply_courses_this_week(event, user_id, user_msg):
+    try:
+        bubbles = []
+        for day, courses in get_course_calendar().week_of(datetime.now().date()):
+            if not courses:
+                continue
+            lines = [
+                {"type": "text", "text": f"📅 {day.month}/{day.day}（{COURSE_WEEKDAY_NAMES[day.weekday()]}）", "weight": "bold", "size": "lg"}
+            ]
+            for row in courses[:10]:
+                lines.append({
+                    "type": "text",
+                    "text": f"• {row.get('課程名稱', '（未提供課程名稱）')} {row.get('時間', '')}｜{row.get('教練姓名', '未知')}",
+                    "size": "sm",
+                    "wrap": True
                 })
+            if len(courses) > 10:
+                lines.append({"type": "text", "text": f"…另有 {len(courses) - 10} 堂，請輸入日期查詢", "size": "xs", "color": "#888888"})
+            bubbles.append({
+                "type": "bubble",
+                "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": lines}
+            })
 
-            line_bot_api.reply_message(
-                event.reply_token,
-                FlexSendMessage(
-                    alt_text=f"{user_msg} 課程內容",
-                    contents={"type": "carousel", "contents": bubbles}
-                )
-            )
+        if not bubbles:
+            send_reply(event, TextSendMessage(text="❌ 本週沒有排定的課程"))
+            return
 
-        except Exception as e:
-            logger.error(f"課程類型查詢錯誤：{e}", exc_info=True)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=f"⚠ 無法查詢課程內容（錯誤：{str(e)}）")
+        send_reply(
+            event,
+            FlexSendMessage(
+                alt_text="本週課程",
+                contents={"type": "carousel", "contents": bubbles}
             )
+        )
 
-    elif re.match(r"^\d{4}[-/]\d{2}[-/]\d{2}$", user_msg):
-        query_date = user_msg.replace("/", "-").strip()
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("課程資料")
-            records = sheet.get_all_records()
-
-            matched = [row for row in records if row.get("開始日期", "").strip() == query_date]
-
-            if not matched:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 該日期無任何課程"))
-                return
+    except Exception as e:
+        logger.error(f"本週課程查詢錯誤：{e}", exc_info=True)
+        send_reply(
+            event,
+            TextSendMessage(text=f"⚠ 無法查詢課程內容（錯誤訊息：{str(e)}）")
+        )
 
-            bubbles = []
-            for row in matched[:10]:
-                bubbles.append({
-                    "type": "bubble",
-                    "body": {
-                        "type": "box",
-                        "layout": "vertical",
-                        "spacing": "sm",
-                        "contents": [
-                            {"type": "text", "text": row.get("課程名稱", "（未提供課程名稱）"), "weight": "bold", "size": "lg", "wrap": True},
-                            {"type": "text", "text": f"👨‍🏫 教練：{row.get('教練姓名', '未知')}", "size": "sm", "wrap": True},
-                            {"type": "text", "text": f"📅 開課日期：{row.get('開始日期', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"🕒 上課時間：{row.get('上課時間', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"⏱️ 時間：{row.get('時間', '未提供')}", "size": "sm"},
-                            {"type": "text", "text": f"💲 價格：{row.get('課程價格', '未定')}", "size": "sm"}
-                        ]
+def build_fitness_log_card():
+    liff_url = "https://liffweb.vercel.app/"  # 這是新專案上線的網址
+    flex_message = FlexSendMessage(
+        alt_text="健身紀錄",
+        contents={
+            "type": "bubble",
+            "hero": {
+                "type": "image",
+                "url": "https://example.com/your_new_image.jpg",  # 替換成您的新圖片網址
+                "size": "full",
+                "aspectRatio": "20:13",
+                "aspectMode": "cover",
+                "action": {
+                    "type": "uri",
+                    "uri": liff_url
+                }
+            },
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "contents": [
+                    {
+                        "type": "button",
+                        "style": "primary",
+                        "height": "md",
+                        "action": {
+                            "type": "uri",
+                            "label": "開始記錄今日健身！",
+                            "uri": liff_url
+                        }
                     }
-                })
-
-            line_bot_api.reply_message(
-                event.reply_token,
-                FlexSendMessage(
-                    alt_text=f"{query_date} 的課程",
-                    contents={"type": "carousel", "contents": bubbles}
-                )
+                ]
+            }
+        }
+    )
+    return flex_message
+
+FITNESS_LOG_CARD = PrebuiltMessage(build_fitness_log_card())
+
+@command_router.command("健身紀錄")
+def reply_fitness_log(event, user_id, user_msg):
+    send_reply(event, FITNESS_LOG_CARD)
+
+@command_router.command("我要預約")
+def start_booking_check(event, user_id, user_msg):
+    if user_id not in user_states or not isinstance(user_states[user_id], BookingFSM):
+        if user_states.get(user_id) == "awaiting_member_check_before_booking":
+            send_reply(
+                event,
+                TextSendMessage(text="請先輸入您的姓名以進行驗證。")
             )
-
-        except Exception as e:
-            logger.error(f"課程日期查詢錯誤：{e}", exc_info=True)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=f"⚠ 無法查詢課程內容（錯誤訊息：{str(e)}）")
+        else:
+            user_states[user_id] = "awaiting_member_check_before_booking"
+            send_reply(
+                event,
+                TextSendMessage(text="您好，請先輸入您的姓名以進行預約。")
             )
+    else:
+        send_reply(event, TextSendMessage(text="您已經在預約流程中，請繼續操作。"))
 
-    elif user_msg == "健身紀錄":
-        liff_url = "https://liffweb.vercel.app/"  # 這是新專案上線的網址
-        flex_message = FlexSendMessage(
-            alt_text="健身紀錄",
-            contents={
-                "type": "bubble",
-                "hero": {
-                    "type": "image",
-                    "url": "https://example.com/your_new_image.jpg",  # 替換成您的新圖片網址
-                    "size": "full",
-                    "aspectRatio": "20:13",
-                    "aspectMode": "cover",
-                    "action": {
-                        "type": "uri",
-                        "uri": liff_url
-                    }
-                },
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "button",
-                            "style": "primary",
-                            "height": "md",
-                            "action": {
-                                "type": "uri",
-                                "label": "開始記錄今日健身！",
-                                "uri": liff_url
-                            }
-                        }
-                    ]
-                }
-            }
-        )
-        line_bot_api.reply_message(event.reply_token, flex_message)
-    elif user_msg == "我要預約":
-        if user_id not in user_states or not isinstance(user_states[user_id], BookingFSM):
-            if user_states.get(user_id) == "awaiting_member_check_before_booking":
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="請先輸入您的姓名以進行驗證。")
-                )
-            else:
-                user_states[user_id] = "awaiting_member_check_before_booking"
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="您好，請先輸入您的姓名以進行預約。")
-                )
+@command_router.state("awaiting_member_check_before_booking")
+def verify_member_for_booking(event, user_id, user_msg):
+    user_states.pop(user_id)
+    keyword = user_msg.strip()
+    logger.info(f"User {user_id}: 預約驗證 - 使用者輸入姓名: '{keyword}'")
+    
+    try:
+        index = get_member_index(SPREADSHEET_KEY)
+        if MEMBER_ID_PATTERN.match(keyword.upper()):
+            member_data = index.find_by_id(keyword)
+            matches = [member_data] if member_data else []
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="您已經在預約流程中，請繼續操作。"))
-
-    elif user_states.get(user_id) == "awaiting_member_check_before_booking":
-        user_states.pop(user_id)
-        keyword = user_msg.strip()
-        logger.info(f"User {user_id}: 預約驗證 - 使用者輸入姓名: '{keyword}'")
-
-        try:
-            client = get_gspread_client()
-            sheet = client.open_by_key(SPREADSHEET_KEY).worksheet("會員資料")
-            records = sheet.get_all_records()
-
-            member_data = next(
-                (row for row in records if keyword in row["姓名"]),
-                None
+            matches = index.search_name(keyword)
+            member_data = pick_single_member(matches, keyword)
+    
+        if len(matches) > 1 and not member_data:
+            logger.info(f"User {user_id}: 預約驗證 - 找到 {len(matches)} 位符合的會員，請使用者選擇")
+            user_states[user_id] = "awaiting_member_check_before_booking"
+            send_reply(
+                event,
+                TextSendMessage(text=format_member_choices(matches))
             )
-
-            if member_data:
-                logger.info(f"User {user_id}: 預約驗證 - 找到會員: {member_data['姓名']}")
-
-            # 建立 FSM 狀態機並啟動流程
-                states = [
-                            'start_booking',
-                            'category_selection',
-                            'expertise_selection',   # 新增：私人教練專長
-                            'coach_selection',       # 新增：教練姓名
-                            'service_selection',
-                            'date_input',
-                            'time_input',
-                            'confirmation',
-                            'completed',
-                            'cancelled'
-                            ]
-                transitions = [
-                                {'trigger': 'start', 'source': 'start_booking', 'dest': 'category_selection', 'after': 'ask_category'},
-                                    # 根據是否為私人教練，走不同流程
-                                {'trigger': 'select_category', 'source': 'category_selection', 'dest': 'expertise_selection',
-                                 'conditions': 'is_personal_coach_category', 'after': 'ask_expertise'},
-                                {'trigger': 'select_category', 'source': 'category_selection', 'dest': 'service_selection',
-                                 'unless': 'is_personal_coach_category', 'after': 'process_category'},
-                                # 專長 → 教練 → 項目（實際上選完教練就可以定義 service）
-                                {'trigger': 'select_expertise', 'source': 'expertise_selection', 'dest': 'coach_selection', 'after': 'ask_coach_name'},
-                                {'trigger': 'select_coach', 'source': 'coach_selection', 'dest': 'date_input', 'after': 'ask_date'},
-                                    # 非私人教練的流程：項目 → 日期
-                                {'trigger': 'select_service', 'source': 'service_selection', 'dest': 'date_input', 'after': 'ask_date'},
-                                {'trigger': 'enter_date', 'source': 'date_input', 'dest': 'time_input', 'after': 'ask_time'},
-                                {'trigger': 'enter_time', 'source': 'time_input', 'dest': 'confirmation', 'after': 'process_time'},
-                                {'trigger': 'confirm_booking', 'source': 'confirmation', 'dest': 'completed', 'after': 'process_booking'},
-                                {'trigger': 'cancel_booking', 'source': '*', 'dest': 'cancelled', 'after': 'send_cancellation_message'},
-                                {'trigger': 'restart_booking', 'source': '*', 'dest': 'start_booking', 'after': 'send_booking_start_message'}
-                            ]
-                fsm = BookingFSM(user_id, states=states, transitions=transitions, initial='start_booking')
-                fsm.member_name = member_data['姓名']  # ✅ 儲存會員姓名
-                user_states[user_id] = fsm
-                fsm.start(event)  # ✅ 啟動預約流程
-
-            else:
-                logger.info(f"User {user_id}: 預約驗證 - 查無此會員")
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="❌ 查無此會員資料，請確認後再試一次。")
-                )
-
-        except Exception as e:
-            logger.error(f"❌ 會員驗證失敗，試算表 KEY：{SPREADSHEET_KEY}，錯誤類型：{type(e).__name__}, 錯誤內容：{e}", exc_info=True)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=f"❌ 會員驗證失敗，請稍後再試。")
+    
+        elif member_data:
+            logger.info(f"User {user_id}: 預約驗證 - 找到會員: {member_data['姓名']}")
+    
+        # 建立 FSM 狀態機並啟動流程
+            wait_for_reference_data()  # 冷啟動時預約選項可能還在背景載入
+            fsm = BookingFSM(user_id, initial='start_booking')
+            fsm.member_name = member_data['姓名']  # ✅ 儲存會員姓名
+            user_states[user_id] = fsm
+            fsm.start(event)  # ✅ 啟動預約流程
+            if user_id in user_states:
+                user_states[user_id] = fsm  # 保存啟動後的狀態
+    
+        else:
+            logger.info(f"User {user_id}: 預約驗證 - 查無此會員")
+            send_reply(
+                event,
+                TextSendMessage(text="❌ 查無此會員資料，請確認後再試一次。")
             )
+    
+    except Exception as e:
+        logger.error(f"❌ 會員驗證失敗，試算表 KEY：{SPREADSHEET_KEY}，錯誤類型：{type(e).__name__}, 錯誤內容：{e}", exc_info=True)
+        send_reply(
+            event,
+            TextSendMessage(text=f"❌ 會員驗證失敗，請稍後再試。")
+        )
+
+@command_router.state(BookingFSM)
+def continue_booking(event, user_id, user_msg):
+    fsm = user_states.get(user_id)
+    if fsm.state == "category_selection":
+        fsm.select_category(event)
+    elif fsm.state == "service_selection":
+        fsm.select_service(event)
+    elif fsm.state == "date_input":
+        fsm.enter_date(event)
+    elif fsm.state == "time_input":
+        fsm.enter_time(event)
+    elif fsm.state == "confirmation":
+        fsm.process_booking(event)  # 確認提示已在輸入時間後送出，這裡處理「確認」/「取消」
     else:
-        fsm = user_states.get(user_id)
-        if isinstance(fsm, BookingFSM):
-            if fsm.state == "category_selection":
-                fsm.select_category(event)
-            elif fsm.state == "service_selection":
-                fsm.select_service(event)
-            elif fsm.state == "date_input":
-                fsm.enter_date(event)
-            elif fsm.state == "time_input":
-                fsm.enter_time(event)
-            elif fsm.state == "confirmation":
-                fsm.confirm_booking(event)
-            else:
-                logger.warning(f"[FSM] 使用者 {user_id} 處於未知狀態：{fsm.state}")
-        else:
-            try:
-                client = get_gspread_client()
-                sheet = client.open_by_key("1jVhpPNfB6UrRaYZjCjyDR4GZApjYLL4KZXQ1Si63Zyg").worksheet("場地資料")
-                records = sheet.get_all_records()
-
-                matched = next((row for row in records if row.get("名稱") == user_msg), None)
-
-                if matched and matched.get("圖片1", "").startswith("https"):
-                    bubble = {
-                        "type": "bubble",
-                        "hero": {
-                            "type": "image",
-                            "url": matched["圖片1"],
-                            "size": "full",
-                            "aspectRatio": "20:13",
-                            "aspectMode": "cover"
-                        },
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "spacing": "sm",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": matched["名稱"],
-                                    "weight": "bold",
-                                    "size": "xl",
-                                    "wrap": True
-                                },
-                                {
-                                    "type": "text",
-                                    "text": matched["描述"],
-                                    "size": "sm",
-                                    "wrap": True,
-                                    "color": "#666666"
-                                }
-                            ]
-                        }
+        logger.warning(f"[FSM] 使用者 {user_id} 處於未知狀態：{fsm.state}")
+    if user_id in user_states:
+        user_states[user_id] = fsm  # 寫回共用的 session store
+
+_venue_names = (None, frozenset())
+
+def known_venue_names():
+    # 以目前手上的場地資料建立名稱集合；還沒有任何資料時回傳 None，交給遠端查詢
+    global _venue_names
+    records = worksheet_cache.peek(MEMBER_SPREADSHEET_KEY, "場地資料")
+    if records is None:
+        records = reference_snapshot.sheets.get("場地資料")
+    if records is None:
+        return None
+    if _venue_names[0] is not records:
+        _venue_names = (records, frozenset(row.get("名稱") for row in records if row.get("名稱")))
+    return _venue_names[1]
+
+def render_venue_detail(records, venue_name):
+    matched = next((row for row in records if row.get("名稱") == venue_name), None)
+
+    if matched and matched.get("圖片1", "").startswith("https"):
+        bubble = {
+            "type": "bubble",
+            "hero": {
+                "type": "image",
+                "url": matched["圖片1"],
+                "size": "full",
+                "aspectRatio": "20:13",
+                "aspectMode": "cover"
+            },
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": matched["名稱"],
+                        "weight": "bold",
+                        "size": "xl",
+                        "wrap": True
+                    },
+                    {
+                        "type": "text",
+                        "text": matched["描述"],
+                        "size": "sm",
+                        "wrap": True,
+                        "color": "#666666"
                     }
+                ]
+            }
+        }
 
-                    flex_msg = FlexSendMessage(
-                        alt_text=f"{matched['名稱']} 詳細資訊",
-                        contents=bubble
-                    )
-                    line_bot_api.reply_message(event.reply_token, flex_msg)
-                else:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 查無該場地資料"))
-
-            except Exception as e:
-                logger.error(f"場地詳情查詢失敗：{e}", exc_info=True)
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
-load_booking_options()  # 載入預約資料選項
+        flex_msg = FlexSendMessage(
+            alt_text=f"{matched['名稱']} 詳細資訊",
+            contents=bubble
+        )
+        return flex_msg
+    else:
+        return TextSendMessage(text="❌ 查無該場地資料")
+
+@command_router.fallback
+def reply_venue_detail(event, user_id, user_msg):
+    venue_names = known_venue_names()
+    if venue_names is not None and user_msg not in venue_names:
+        send_reply(event, TextSendMessage(text="❌ 查無該場地資料"))
+        return
+    try:
+        send_reply(event, render_cache.get_marked(render_venue_detail, "場地資料", user_msg, where={"名稱": user_msg}))
+    except Exception as e:
+        logger.error(f"場地詳情查詢失敗：{e}", exc_info=True)
+        send_reply(event, TextSendMessage(text=f"⚠ 發生錯誤：{e}"))
+if restore_reference_snapshot() or STARTUP_MODE == "lazy":
+    # 冷啟動不等試算表：參考資料在背景載入（有快照檔時先用快照回應），需要預約選項的流程再等它完成
+    Thread(target=refresh_reference_data, name="reference-initial-load", daemon=True).start()
+else:
+    refresh_reference_data()  # 載入預約資料選項與參考資料
+start_reference_refresher()
+booking_journal.start()  # 啟動時也會補寫上次未完成的預約
+push_dispatcher.start()
+if read_model is not None:
+    read_model.start()
 if __name__ == "__main__":
     
     app.run()
@@ -0,0 +1,22 @@
+# bench 腳本共用的載入工具：設定量測用的環境變數，再以檔案路徑載入 api/linebot.py
+import importlib.util
+import logging
+import os
+import sys
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api", "linebot.py")
+
+
+def load_bot():
+    # api/linebot.py 與 line-bot-sdk 的 linebot 套件同名，改用檔案路徑載入
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+    os.environ.setdefault("REFERENCE_REFRESH_INTERVAL", "0")
+    os.environ.setdefault("BOOKING_JOURNAL_PATH", ":memory:")
+    os.environ.setdefault("REFERENCE_SNAPSHOT_PATH", "")
+    logging.disable(logging.CRITICAL)
+    spec = importlib.util.spec_from_file_location("linebot_app", BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules["linebot_app"] = bot
+    spec.loader.exec_module(bot)
+    return bot
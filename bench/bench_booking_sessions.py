@@ -0,0 +1,103 @@
+# 預約流程效能量測：每個進行中 session 的記憶體用量與狀態轉換吞吐量
+# 用法：python bench/bench_booking_sessions.py [--sessions 100000] [--compare-graph]
+# session 經由正式的 user_states（記憶體後端）存取，回覆訊息的 callback 照常執行，只有送往 LINE 的 HTTP 呼叫被略過
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+
+import _load
+
+
+def load_bot():
+    bot = _load.load_bot()
+    bot.line_bot_api._post = lambda *args, **kwargs: None  # 不真的呼叫 LINE API
+    bot.booking_options = {"categories": {"場地租借": {"items": ["A 教室"]}}}
+    return bot
+
+
+class BenchSource:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+class BenchMessage:
+    text = "預約"
+
+
+class BenchEvent:
+    # send_reply 需要的欄位：reply token、時間戳記與來源使用者
+    def __init__(self, user_id):
+        self.reply_token = "bench-token"
+        self.timestamp = int(time.time() * 1000)
+        self.source = BenchSource(user_id)
+        self.message = BenchMessage()
+
+
+def measure_memory(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = [factory(f"U{i:032d}") for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return sessions, used / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--compare-graph", action="store_true", help="同時量測舊版每人一個 GraphMachine 的作法（取樣 1000 筆）")
+    args = parser.parse_args()
+
+    # 上限要容得下所有 session，否則量到的是被 LRU 淘汰後的結果
+    os.environ["SESSION_BACKEND"] = "memory"
+    os.environ["SESSION_MAX_ENTRIES"] = str(max(args.sessions, 1))
+    bot = load_bot()
+    user_states = bot.user_states
+
+    def store_session(user_id):
+        # 與 verify_member_for_booking 相同：建立狀態機後寫進共用的 session store
+        user_states[user_id] = bot.BookingFSM(user_id, initial="start_booking")
+        return user_id
+
+    user_ids, per_session = measure_memory(store_session, args.sessions)
+    print(f"sessions: {args.sessions}")
+    print(f"memory per session (session store): {per_session:.0f} bytes")
+
+    # 每則訊息的實際路徑：從 store 讀出狀態機、觸發轉換（含回覆 callback）、再寫回
+    started = time.perf_counter()
+    for user_id in user_ids:
+        event = BenchEvent(user_id)
+        fsm = user_states.get(user_id)
+        fsm.start(event)
+        user_states[user_id] = fsm
+        fsm = user_states.get(user_id)
+        fsm.restart_booking(event)
+        user_states[user_id] = fsm
+    elapsed = time.perf_counter() - started
+    print(f"transitions/sec (load + transition + reply + store): {2 * len(user_ids) / elapsed:,.0f}")
+
+    if args.compare_graph:
+        from transitions.extensions import GraphMachine
+        sample = 1000
+
+        def graph_factory(user_id):
+            return GraphMachine(states=bot.BOOKING_STATES, transitions=[
+                {key: t[key] for key in ("trigger", "source", "dest")} for t in bot.BOOKING_TRANSITIONS
+            ], initial="start_booking")
+
+        machines, per_machine = measure_memory(graph_factory, sample)
+        started = time.perf_counter()
+        for machine in machines:
+            machine.start()
+            machine.restart_booking()
+        elapsed = time.perf_counter() - started
+        print(f"GraphMachine memory per session: {per_machine:.0f} bytes (sample {sample}, machine only, no callbacks)")
+        print(f"GraphMachine transitions/sec: {2 * sample / elapsed:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
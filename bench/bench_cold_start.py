@@ -0,0 +1,99 @@
+# 冷啟動效能量測：每輪開一個新的 Python 行程，量模組載入時間與第一個 webhook 請求的延遲
+# 用法：python bench/bench_cold_start.py [--runs 5] [--mode eager|lazy|both]
+# 沒有設定 GOOGLE_APPLICATION_CREDENTIALS_CONTENT 時，eager 模式的試算表讀取會立刻失敗，量到的是不含網路的下限
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["gspread", "google.oauth2.service_account", "google.auth.transport.requests", "schedule", "transitions"]
+CHANNEL_SECRET = "bench"
+
+
+def run_child():
+    # 子行程：從乾淨的直譯器載入 bot，再送一個會員專區的 webhook
+    from _load import load_bot
+
+    os.environ["LINE_CHANNEL_SECRET"] = CHANNEL_SECRET
+    started = time.perf_counter()
+    bot = load_bot()
+    import_ms = (time.perf_counter() - started) * 1000
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    bot.line_bot_api._post = lambda *args, **kwargs: None  # 不真的呼叫 LINE API
+    body = json.dumps({
+        "destination": "bench",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": "U_cold_start"},
+            "webhookEventId": "bench",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": "bench-token",
+            "message": {"type": "text", "id": "1", "quoteToken": "q", "text": "會員專區"}
+        }]
+    }, ensure_ascii=False)
+    signature = base64.b64encode(
+        hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    ).decode()
+
+    started = time.perf_counter()
+    response = bot.app.test_client().post(
+        "/webhook", data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"}
+    )
+    first_request_ms = (time.perf_counter() - started) * 1000
+    bot.reference_ready.wait(30)  # 等背景載入結束再離開，避免直譯器關閉時還在匯入套件
+
+    print(json.dumps({
+        "import_ms": import_ms,
+        "first_request_ms": first_request_ms,
+        "status": response.status_code,
+        "heavy_modules": loaded
+    }))
+
+
+def measure(mode, runs):
+    env = dict(os.environ, STARTUP_MODE=mode)
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mode", choices=["eager", "lazy", "both"], default="both")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return
+
+    modes = ["eager", "lazy"] if args.mode == "both" else [args.mode]
+    print(f"{'模式':<8}{'載入 (ms)':>12}{'第一個請求 (ms)':>18}  載入後已匯入的重型套件")
+    for mode in modes:
+        results = measure(mode, args.runs)
+        import_ms = statistics.median(r["import_ms"] for r in results)
+        first_request_ms = statistics.median(r["first_request_ms"] for r in results)
+        statuses = {r["status"] for r in results}
+        heavy = ", ".join(results[-1]["heavy_modules"]) or "（無）"
+        print(f"{mode:<8}{import_ms:>12.1f}{first_request_ms:>18.1f}  {heavy}")
+        if statuses != {200}:
+            print(f"  ⚠ webhook 回應狀態：{sorted(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# 指令路由效能量測：每則訊息從文字到找出處理函式的成本
+# 用法：python bench/bench_router.py [--iterations 200000]
+import argparse
+import time
+
+from _load import load_bot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.user_states["U_member_query"] = "awaiting_member_info"
+    bot.user_states["U_booking"] = bot.BookingFSM("U_booking", initial="date_input")
+    bot.worksheet_cache.put(bot.MEMBER_SPREADSHEET_KEY, "場地資料", [{"名稱": f"場地{i}"} for i in range(200)])
+
+    cases = [
+        ("第一個指令", "U_idle", "會員專區"),
+        ("最後一個指令", "U_idle", "我要預約"),
+        ("日期查詢", "U_idle", "2025-05-01"),
+        ("查詢會員中", "U_member_query", "王小明"),
+        ("預約流程中", "U_booking", "2025-05-01"),
+        ("未知文字", "U_idle", "隨便打的字"),
+    ]
+    for label, user_id, text in cases:
+        resolve = bot.command_router.resolve
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            handler = resolve(user_id, text)
+        elapsed = time.perf_counter() - started
+        print(f"{label:<8} {text:<10} -> {handler.__name__:<26} {elapsed / args.iterations * 1e6:.2f} µs/msg")
+
+    venue_names = bot.known_venue_names
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        "隨便打的字" in venue_names()
+    elapsed = time.perf_counter() - started
+    print(f"未知文字的場地名稱檢查 {elapsed / args.iterations * 1e6:.2f} µs/msg（不需遠端查詢）")
+
+
+if __name__ == "__main__":
+    main()